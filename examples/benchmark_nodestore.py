@@ -0,0 +1,55 @@
+"""Compare the node location stores in pyosm.nodestore.
+
+Stores N nodes with increasing, slightly gappy ids (like an extract) in each
+backend, then looks up N random ids. Every backend runs in its own process so
+that resident memory can be compared fairly.
+
+    python benchmark_nodestore.py [N]
+"""
+
+from multiprocessing import Process, Queue
+from pyosm.nodestore import DictNodeStore, DenseNodeStore, SparseNodeStore
+import random
+import sys
+import time
+
+def resident_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * 4096
+
+def run(store_class, n, results):
+    random.seed(42)
+    ids = []
+    node_id = 0
+    for i in range(n):
+        node_id += random.randint(1, 4)
+        ids.append(node_id)
+    probes = [random.choice(ids) for i in range(n)]
+
+    before = resident_bytes()
+    store = store_class()
+
+    start = time.time()
+    for node_id in ids:
+        store[node_id] = (random.uniform(-180, 180), random.uniform(-90, 90))
+    store_secs = time.time() - start
+
+    start = time.time()
+    for node_id in probes:
+        store.get(node_id)
+    lookup_secs = time.time() - start
+
+    results.put((store_class.__name__, n / store_secs, n / lookup_secs, resident_bytes() - before))
+    store.close()
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    print('%-16s %14s %14s %12s' % ('store', 'stores/sec', 'lookups/sec', 'RSS (MB)'))
+    for store_class in (DictNodeStore, DenseNodeStore, SparseNodeStore):
+        results = Queue()
+        p = Process(target=run, args=(store_class, n, results))
+        p.start()
+        name, stores, lookups, rss = results.get()
+        p.join()
+        print('%-16s %14d %14d %12.1f' % (name, stores, lookups, rss / 1e6))
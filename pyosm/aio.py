@@ -0,0 +1,238 @@
+"""asyncio versions of the replication, changeset and notes streams in
+pyosm.parsing, so that many feeds can be followed from one event loop.
+
+They yield the same things as their pyosm.parsing counterparts. Waiting is
+done with asyncio.sleep, and downloads use aiohttp when it is installed or
+otherwise pyosm.httpclient in an executor. Diffs are downloaded whole and
+then decompressed and parsed in an executor (the loop's default thread pool
+unless one is passed in; a ProcessPoolExecutor works too), so the event loop
+stays responsive. Prefetching and the disk cache are only available in the
+synchronous streams. Needs Python 3.6 or later."""
+
+import asyncio
+import datetime
+import io
+import os.path
+import pyosm.httpclient as httpclient
+import pyosm.model as model
+from pyosm.parsing import (
+    _DecompressingReader, _parse_note, _parse_notes_feed, _sequence_url,
+    _stateTimestamp, find_sequence_for_timestamp, iter_osm_change_file,
+    iter_osm_file, readState,
+)
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+def _read_url(url):
+    f = httpclient.get(url)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def _parse_osc(data, parse_timestamps):
+    return list(iter_osm_change_file(_DecompressingReader(io.BytesIO(data)), parse_timestamps))
+
+def _parse_changesets(data, parse_timestamps):
+    return list(iter_osm_file(_DecompressingReader(io.BytesIO(data)), parse_timestamps))
+
+def _parse_state(data, sep='='):
+    text = data.decode('utf-8')
+    return text, readState(text.splitlines(), sep)
+
+class _Fetcher(object):
+    """Downloads URLs without blocking the event loop, with the same retries
+    and HTTPError as pyosm.httpclient's default client."""
+
+    def __init__(self, session=None, executor=None):
+        self._session = session
+        self._owned = False
+        self.executor = executor
+
+    async def __aenter__(self):
+        if self._session is None and aiohttp is not None:
+            self._session = aiohttp.ClientSession(headers={'User-Agent': httpclient.USER_AGENT})
+            self._owned = True
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self._owned:
+            await self._session.close()
+
+    async def run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    async def get(self, url):
+        if self._session is None:
+            return await asyncio.get_event_loop().run_in_executor(None, _read_url, url)
+
+        client = httpclient.default_client()
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                async with self._session.get(url) as response:
+                    if response.status not in httpclient.RETRY_STATUSES or attempt >= client.retries:
+                        if response.status >= 400:
+                            raise httpclient.HTTPError(url, response.status, response.reason)
+                        return await response.read()
+                    retry_after = response.headers.get('Retry-After')
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= client.retries:
+                    raise
+
+            await asyncio.sleep(client._delay(attempt, retry_after))
+            attempt += 1
+
+    async def state(self, url, sep='='):
+        return _parse_state(await self.get(url), sep)
+
+    async def wait_for_state(self, url):
+        """Like pyosm.parsing._wait_for_state, fetch a state file once it has
+        been published and return (text, state, seconds spent waiting)."""
+        delay = 1.0
+        waited = 0.0
+        while True:
+            try:
+                state_text, state = await self.state(url)
+                return state_text, state, waited
+            except httpclient.HTTPError as e:
+                if e.code != 404:
+                    raise
+                await asyncio.sleep(delay)
+                waited += delay
+                delay = min(delay * 2, 13)
+
+async def aiter_osm_stream(start_sqn=None, base_url='https://planet.openstreetmap.org/replication/minute', expected_interval=60, parse_timestamps=True, state_dir=None, start_time=None, session=None, executor=None):
+    """An async generator version of pyosm.parsing.iter_osm_stream. session is
+    an optional aiohttp.ClientSession to share between streams and executor
+    is where diffs are parsed."""
+
+    async with _Fetcher(session, executor) as fetcher:
+        # If the user specifies a state_dir, read the state from the statefile there
+        if state_dir:
+            if not os.path.exists(state_dir):
+                raise Exception('Specified state_dir "%s" doesn\'t exist.' % state_dir)
+
+            if os.path.exists('%s/state.txt' % state_dir):
+                with open('%s/state.txt' % state_dir) as f:
+                    state = readState(f)
+                    start_sqn = state['sequenceNumber']
+
+        if not start_sqn and start_time is not None:
+            start_sqn = await fetcher.run(find_sequence_for_timestamp, base_url, start_time)
+
+        # If no start_sqn, assume to start from the most recent diff. A
+        # start_sqn (or start_time) may be for the next diff to be published.
+        if not start_sqn:
+            state_text, state = await fetcher.state('%s/state.txt' % base_url)
+        else:
+            state_text, state, waited = await fetcher.wait_for_state(_sequence_url(base_url, start_sqn, '.state.txt'))
+
+        interval_fudge = 0.0
+
+        while True:
+            data = await fetcher.get(_sequence_url(base_url, state['sequenceNumber'], '.osc.gz'))
+            for a in await fetcher.run(_parse_osc, data, parse_timestamps):
+                yield a
+
+            # After parsing the OSC, check to see how much time is remaining
+            stateTs = _stateTimestamp(state)
+            yield (None, model.Finished(state['sequenceNumber'], stateTs))
+
+            nextTs = stateTs + datetime.timedelta(seconds=expected_interval + interval_fudge)
+            if datetime.datetime.utcnow() < nextTs:
+                await asyncio.sleep((nextTs - datetime.datetime.utcnow()).total_seconds())
+
+            # Then try to fetch the next state file
+            url = _sequence_url(base_url, int(state['sequenceNumber']) + 1, '.state.txt')
+            state_text, state, waited = await fetcher.wait_for_state(url)
+            interval_fudge += waited
+            interval_fudge -= (interval_fudge / 2.0)
+
+            if state_dir:
+                with open('%s/state.txt' % state_dir, 'w') as f:
+                    f.write(state_text)
+
+async def aiter_changeset_stream(start_sqn=None, base_url='https://planet.openstreetmap.org/replication/changesets', expected_interval=60, parse_timestamps=True, state_dir=None, start_time=None, session=None, executor=None):
+    """An async generator version of pyosm.parsing.iter_changeset_stream. See
+    aiter_osm_stream for session and executor."""
+
+    async with _Fetcher(session, executor) as fetcher:
+        # If the user specifies a state_dir, read the state from the statefile there
+        if state_dir:
+            if not os.path.exists(state_dir):
+                raise Exception('Specified state_dir "%s" doesn\'t exist.' % state_dir)
+
+            if os.path.exists('%s/state.yaml' % state_dir):
+                with open('%s/state.yaml' % state_dir) as f:
+                    state = readState(f, ': ')
+                    start_sqn = state['sequence']
+
+        if not start_sqn and start_time is not None:
+            start_sqn = await fetcher.run(find_sequence_for_timestamp, base_url, start_time)
+
+        # If no start_sqn, assume to start from the most recent changeset file
+        if not start_sqn:
+            state_text, state = await fetcher.state('%s/state.yaml' % base_url, ': ')
+            sequenceNumber = int(state['sequence'])
+        else:
+            sequenceNumber = int(start_sqn)
+
+        while True:
+            url = _sequence_url(base_url, sequenceNumber, '.osm.gz')
+
+            delay = 1.0
+            while True:
+                try:
+                    data = await fetcher.get(url)
+                    break
+                except httpclient.HTTPError as e:
+                    if e.code != 404:
+                        raise
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 13)
+
+            for obj in await fetcher.run(_parse_changesets, data, parse_timestamps):
+                yield obj
+
+            yield model.Finished(sequenceNumber, None)
+
+            sequenceNumber += 1
+
+            if state_dir:
+                with open('%s/state.yaml' % state_dir, 'w') as f:
+                    f.write('sequence: %d' % sequenceNumber)
+
+async def aiter_osm_notes(feed_limit=25, interval=60, parse_timestamps=True, base_url='https://www.openstreetmap.org/api/0.6', session=None, executor=None):
+    """An async generator version of pyosm.parsing.iter_osm_notes. See
+    aiter_osm_stream for session and executor."""
+
+    async with _Fetcher(session, executor) as fetcher:
+        last_seen_guid = None
+        while True:
+            data = await fetcher.get('%s/notes/feed?limit=%d' % (base_url, feed_limit))
+
+            new_notes = []
+            for action, guid in await fetcher.run(_parse_notes_feed, io.BytesIO(data)):
+                if last_seen_guid == guid:
+                    break
+                elif last_seen_guid == None:
+                    # The first time through we want the first item to be the "last seen"
+                    # because the RSS feed is newest-to-oldest
+                    last_seen_guid = guid
+                else:
+                    note_id = int(guid.split('/')[-1].split('#c')[0])
+                    note = await fetcher.get('%s/notes/%d' % (base_url, note_id))
+                    new_notes.append((action, await fetcher.run(_parse_note, io.BytesIO(note), parse_timestamps)))
+
+            # We yield the reversed list because we want to yield in change order
+            # (i.e. "oldest to most current")
+            for note in reversed(new_notes):
+                yield note
+
+            yield model.Finished(None, None)
+
+            await asyncio.sleep(interval)
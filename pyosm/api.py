@@ -1,18 +1,21 @@
-import urllib2
+from pyosm.httpclient import default_client, USER_AGENT
 from pyosm.parsing import iter_osm_file, iter_osm_change_file
 
 class Api(object):
-    def __init__(self, base_url='http://api.openstreetmap.org/api'):
+    def __init__(self, base_url='http://api.openstreetmap.org/api', client=None):
         self._base = base_url
-        self.USER_AGENT = 'pyosm/1.0 (http://github.com/iandees/pyosm)'
+        self._client = client
+        self.USER_AGENT = USER_AGENT
 
     def _get(self, path, params={}):
         headers = {
             'User-Agent': self.USER_AGENT
         }
-        req = urllib2.Request(self._base + path, headers=headers)
+        # The API takes lists of ids comma separated, e.g. nodes=1,2,3
+        params = dict((k, ','.join(str(i) for i in v) if isinstance(v, (list, tuple, set)) else v) for k, v in params.items())
+        client = self._client if self._client is not None else default_client()
 
-        return urllib2.urlopen(req)
+        return client.get(self._base + path, params=params, headers=headers)
 
     def _get_as_osm(self, path, params={}):
         return [t for t in iter_osm_file(self._get(path, params))]
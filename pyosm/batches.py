@@ -0,0 +1,228 @@
+import array
+import collections
+import numpy
+from pyosm.model import ID_TYPECODE
+from pyosm.parsing import _iter_parse, isoToEpoch
+
+## Columnar batches
+# Each batch holds batch_size elements of one type as parallel NumPy arrays.
+# Missing integer attributes are -1 and missing coordinates are NaN. Timestamps
+# are int64 seconds since the Unix epoch. Variable-length children (tags, way
+# nodes, relation members) are flattened, and element i's children are
+# children[offsets[i]:offsets[i + 1]]. Tag keys/values and member roles are
+# indexes into the `strings` StringTable shared by every batch of a parse.
+NodeBatch = collections.namedtuple('NodeBatch', 'id, version, changeset, uid, timestamp, lat, lon, tag_offsets, tag_keys, tag_values, strings')
+WayBatch = collections.namedtuple('WayBatch', 'id, version, changeset, uid, timestamp, nd_offsets, nds, tag_offsets, tag_keys, tag_values, strings')
+RelationBatch = collections.namedtuple('RelationBatch', 'id, version, changeset, uid, timestamp, member_offsets, member_types, member_refs, member_roles, tag_offsets, tag_keys, tag_values, strings')
+
+MEMBER_TYPES = ('node', 'way', 'relation')
+_MEMBER_TYPE_CODES = dict((t, i) for i, t in enumerate(MEMBER_TYPES))
+
+class StringTable(object):
+    """Assigns a stable integer index to each distinct string it sees."""
+
+    def __init__(self):
+        self.strings = []
+        self._indexes = {}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, i):
+        return self.strings[i]
+
+    def index(self, s):
+        i = self._indexes.get(s)
+        if i is None:
+            i = len(self.strings)
+            self._indexes[s] = i
+            self.strings.append(s)
+        return i
+
+def _maybeInt(s):
+    return int(s) if s is not None else -1
+
+def _maybeFloat(s):
+    return float(s) if s is not None else float('nan')
+
+def _maybeEpoch(s):
+    return isoToEpoch(s) if s is not None else -1
+
+def _numpy(values, dtype):
+    return numpy.frombuffer(values, dtype=dtype).copy() if len(values) else numpy.empty(0, dtype=dtype)
+
+class _Columns(object):
+    """Accumulates the columns shared by every element type."""
+
+    def __init__(self):
+        self.ids = array.array(ID_TYPECODE)
+        self.versions = array.array(ID_TYPECODE)
+        self.changesets = array.array(ID_TYPECODE)
+        self.uids = array.array(ID_TYPECODE)
+        self.timestamps = array.array(ID_TYPECODE)
+        self.tag_offsets = array.array(ID_TYPECODE, [0])
+        self.tag_keys = array.array(ID_TYPECODE)
+        self.tag_values = array.array(ID_TYPECODE)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def start(self, attrib):
+        self.ids.append(int(attrib['id']))
+        self.versions.append(_maybeInt(attrib.get('version')))
+        self.changesets.append(_maybeInt(attrib.get('changeset')))
+        self.uids.append(_maybeInt(attrib.get('uid')))
+        self.timestamps.append(_maybeEpoch(attrib.get('timestamp')))
+
+    def end(self):
+        self.tag_offsets.append(len(self.tag_keys))
+
+    def common(self):
+        return (
+            _numpy(self.ids, numpy.int64),
+            _numpy(self.versions, numpy.int64),
+            _numpy(self.changesets, numpy.int64),
+            _numpy(self.uids, numpy.int64),
+            _numpy(self.timestamps, numpy.int64),
+        )
+
+    def tags(self):
+        return (
+            _numpy(self.tag_offsets, numpy.int64),
+            _numpy(self.tag_keys, numpy.int64),
+            _numpy(self.tag_values, numpy.int64),
+        )
+
+class _NodeColumns(_Columns):
+    def __init__(self):
+        super(_NodeColumns, self).__init__()
+        self.lats = array.array('d')
+        self.lons = array.array('d')
+
+    def start(self, attrib):
+        super(_NodeColumns, self).start(attrib)
+        self.lats.append(_maybeFloat(attrib.get('lat')))
+        self.lons.append(_maybeFloat(attrib.get('lon')))
+
+    def batch(self, strings):
+        return NodeBatch(*(self.common() + (_numpy(self.lats, numpy.float64), _numpy(self.lons, numpy.float64)) + self.tags() + (strings,)))
+
+class _WayColumns(_Columns):
+    def __init__(self):
+        super(_WayColumns, self).__init__()
+        self.nd_offsets = array.array(ID_TYPECODE, [0])
+        self.nds = array.array(ID_TYPECODE)
+
+    def end(self):
+        super(_WayColumns, self).end()
+        self.nd_offsets.append(len(self.nds))
+
+    def batch(self, strings):
+        return WayBatch(*(self.common() + (_numpy(self.nd_offsets, numpy.int64), _numpy(self.nds, numpy.int64)) + self.tags() + (strings,)))
+
+class _RelationColumns(_Columns):
+    def __init__(self):
+        super(_RelationColumns, self).__init__()
+        self.member_offsets = array.array(ID_TYPECODE, [0])
+        self.member_types = array.array('b')
+        self.member_refs = array.array(ID_TYPECODE)
+        self.member_roles = array.array(ID_TYPECODE)
+
+    def end(self):
+        super(_RelationColumns, self).end()
+        self.member_offsets.append(len(self.member_refs))
+
+    def batch(self, strings):
+        members = (
+            _numpy(self.member_offsets, numpy.int64),
+            _numpy(self.member_types, numpy.int8),
+            _numpy(self.member_refs, numpy.int64),
+            _numpy(self.member_roles, numpy.int64),
+        )
+        return RelationBatch(*(self.common() + members + self.tags() + (strings,)))
+
+_COLUMNS = {
+    'node': _NodeColumns,
+    'way': _WayColumns,
+    'relation': _RelationColumns,
+}
+
+class _BatchTarget(object):
+    """An lxml parser target that appends elements straight into column arrays
+    and emits a batch whenever batch_size elements of one type are collected,
+    or when the element type changes."""
+
+    def __init__(self, batch_size, strings):
+        self.batch_size = batch_size
+        self.strings = strings
+        self.objects = []
+        self.kind = None
+        self.columns = None
+
+        self._starts = {
+            'tag': self._start_tag,
+            'nd': self._start_nd,
+            'member': self._start_member,
+        }
+        self._ends = {}
+        for tag in _COLUMNS:
+            self._starts[tag] = self._start_element
+            self._ends[tag] = self._end_element
+
+    def start(self, tag, attrib):
+        handler = self._starts.get(tag)
+        if handler is not None:
+            handler(tag, attrib)
+
+    def end(self, tag):
+        handler = self._ends.get(tag)
+        if handler is not None:
+            handler(tag)
+
+    def close(self):
+        self.flush()
+
+    def flush(self):
+        if self.columns is not None and len(self.columns):
+            self.objects.append((None, self.columns.batch(self.strings)))
+        self.columns = None
+
+    def _start_element(self, tag, attrib):
+        if tag != self.kind:
+            self.flush()
+            self.kind = tag
+        if self.columns is None:
+            self.columns = _COLUMNS[tag]()
+        self.columns.start(attrib)
+
+    def _end_element(self, tag):
+        self.columns.end()
+        if len(self.columns) >= self.batch_size:
+            self.flush()
+
+    def _start_tag(self, tag, attrib):
+        if self.columns is None:
+            return
+        self.columns.tag_keys.append(self.strings.index(attrib['k']))
+        self.columns.tag_values.append(self.strings.index(attrib['v']))
+
+    def _start_nd(self, tag, attrib):
+        self.columns.nds.append(int(attrib['ref']))
+
+    def _start_member(self, tag, attrib):
+        self.columns.member_types.append(_MEMBER_TYPE_CODES[attrib['type']])
+        self.columns.member_refs.append(int(attrib['ref']))
+        self.columns.member_roles.append(self.strings.index(attrib['role']))
+
+def iter_osm_file_batches(f, batch_size=65536, strings=None):
+    """Parse a file-like or filename containing OSM XML and yield NodeBatch,
+    WayBatch and RelationBatch tuples of NumPy arrays holding up to batch_size
+    elements each, without building a model object per element.
+
+    Batches are yielded in file order. Tag and role strings are stored once in
+    a StringTable that every batch refers to; pass one in as strings to share
+    it across several files."""
+
+    target = _BatchTarget(batch_size, strings if strings is not None else StringTable())
+    for action, batch in _iter_parse(f, target):
+        yield batch
@@ -0,0 +1,164 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import pyosm.httpclient as httpclient
+
+# Downloads are written to a dot-file in the cache directory until they're
+# complete. Ones this old were left behind by a process that died part way
+# through, rather than belonging to a download still in progress elsewhere.
+_STALE_DOWNLOAD_AGE = 3600
+
+class CacheMiss(Exception):
+    """Raised by an offline DiskCache for a URL it doesn't have."""
+
+class DiskCache(object):
+    """A directory of downloaded files keyed by URL, for replication diffs and
+    state files, which never change once published. The directory is kept
+    under max_bytes by deleting the least recently used files.
+
+    With offline=True nothing is downloaded, and opening a URL that isn't
+    cached raises CacheMiss, so a stream can be replayed from the cache
+    alone."""
+
+    def __init__(self, path, max_bytes=1 << 30, offline=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self._lock = threading.Lock()
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        self._size = 0
+        stale = time.time() - _STALE_DOWNLOAD_AGE
+        for name in os.listdir(path):
+            filename = os.path.join(path, name)
+            try:
+                st = os.stat(filename)
+                if not name.startswith('.'):
+                    self._size += st.st_size
+                elif name.startswith('.download-') and st.st_mtime < stale:
+                    os.remove(filename)
+            except OSError:
+                continue
+
+    def _filename(self, url):
+        return os.path.join(self.path, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def __contains__(self, url):
+        return os.path.exists(self._filename(url))
+
+    def open(self, url, complete_on_eof=True):
+        """Return a binary file-like of the contents of url, read from the
+        cache when possible. Otherwise it is downloaded, and saved in the
+        cache once the whole response has been read and its length matches
+        the Content-Length header.
+
+        Callers that check the data themselves, like a decompressor that has
+        to reach the end of its stream, pass complete_on_eof=False. A download
+        is then only saved once they call the reader's complete() method
+        after reading it to the end. Files from the cache have no complete()
+        method."""
+
+        filename = self._filename(url)
+        try:
+            f = open(filename, 'rb')
+        except (IOError, OSError):
+            if self.offline:
+                raise CacheMiss(url)
+            return _CachingReader(self, filename, httpclient.get(url), complete_on_eof)
+
+        # Mark it as recently used. It may have just been evicted, but the
+        # open file can still be read.
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return f
+
+    def _add(self, temp, filename, size):
+        with self._lock:
+            if os.path.exists(filename):
+                self._size -= os.path.getsize(filename)
+            getattr(os, 'replace', os.rename)(temp, filename)
+            self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Go a little under the limit so that every new file doesn't mean
+        # listing the whole directory again.
+        target = self.max_bytes * 9 // 10
+        entries = []
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            filename = os.path.join(self.path, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+
+        entries.sort()
+        for mtime, size, filename in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            self._size -= size
+
+class _CachingReader(object):
+    """Passes a download through while copying it to a temporary file, which
+    becomes the cache entry once the download is known to be whole. Anything
+    else, like a download that is closed early or cut short, isn't cached."""
+
+    def __init__(self, cache, filename, response, complete_on_eof=True):
+        self._cache = cache
+        self._filename = filename
+        self._response = response
+        self._complete_on_eof = complete_on_eof
+        fd, self._temp = tempfile.mkstemp(dir=cache.path, prefix='.download-')
+        self._file = os.fdopen(fd, 'wb')
+        self._size = 0
+        self._ended = False
+
+    def read(self, size=-1):
+        data = self._response.read(size)
+        if self._file is not None and not self._ended:
+            if data:
+                self._file.write(data)
+                self._size += len(data)
+            if size is None or size < 0 or not data:
+                self._end()
+        return data
+
+    def _end(self):
+        self._ended = True
+        length = self._response.getheader('Content-Length')
+        if length is not None and length.isdigit() and int(length) != self._size:
+            self._discard()
+        elif self._complete_on_eof:
+            self.complete()
+
+    def complete(self):
+        """Save the download in the cache, if it has been read to the end."""
+        if self._file is None or not self._ended:
+            return
+        self._file.close()
+        self._file = None
+        self._cache._add(self._temp, self._filename, self._size)
+
+    def _discard(self):
+        self._file.close()
+        self._file = None
+        os.remove(self._temp)
+
+    def close(self):
+        if self._file is not None:
+            self._discard()
+        self._response.close()
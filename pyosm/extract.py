@@ -0,0 +1,192 @@
+import datetime
+from xml.sax.saxutils import quoteattr
+from pyosm.idset import IdBitmap
+from pyosm.model import Node, Way, Relation, CompactNode, CompactWay, CompactRelation
+from pyosm.parsing import iter_osm_file
+
+## Writing OSM XML
+
+def _timestamp(t):
+    if isinstance(t, datetime.datetime):
+        return t.strftime('%Y-%m-%dT%H:%M:%SZ')
+    if isinstance(t, int):
+        return datetime.datetime.utcfromtimestamp(t).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return t
+
+def _attributes(obj):
+    attrs = [' id="%d"' % obj.id]
+    if obj.version is not None:
+        attrs.append(' version="%d"' % obj.version)
+    if obj.changeset is not None:
+        attrs.append(' changeset="%d"' % obj.changeset)
+    if obj.timestamp is not None:
+        attrs.append(' timestamp=%s' % quoteattr(_timestamp(obj.timestamp)))
+    if obj.user is not None:
+        attrs.append(' user=%s' % quoteattr(obj.user))
+    if obj.uid is not None:
+        attrs.append(' uid="%d"' % obj.uid)
+    if obj.visible is not None:
+        attrs.append(' visible="%s"' % ('true' if obj.visible else 'false'))
+    return attrs
+
+class OSMWriter(object):
+    """Writes nodes, ways and relations (regular or compact) to a file-like or
+    filename as OSM XML. bounds is an optional (min_lon, min_lat, max_lon,
+    max_lat) tuple written as the file's <bounds> element."""
+
+    def __init__(self, out, bounds=None):
+        if hasattr(out, 'write'):
+            self._file = out
+            self._owned = False
+        else:
+            self._file = open(out, 'wb')
+            self._owned = True
+
+        self._write(u'<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="pyosm">\n')
+        if bounds is not None:
+            self._write(u' <bounds minlat="%.7f" minlon="%.7f" maxlat="%.7f" maxlon="%.7f"/>\n' % (bounds[1], bounds[0], bounds[3], bounds[2]))
+
+    def _write(self, text):
+        self._file.write(text.encode('utf-8'))
+
+    def write(self, obj):
+        kind = type(obj)
+        lines = []
+        if kind in (Node, CompactNode):
+            tag = u'node'
+            attrs = _attributes(obj)
+            if obj.lat is not None and obj.lon is not None:
+                attrs.append(' lat="%.7f" lon="%.7f"' % (obj.lat, obj.lon))
+        elif kind in (Way, CompactWay):
+            tag = u'way'
+            attrs = _attributes(obj)
+            lines.extend(u'  <nd ref="%d"/>\n' % ref for ref in obj.nds or ())
+        elif kind in (Relation, CompactRelation):
+            tag = u'relation'
+            attrs = _attributes(obj)
+            lines.extend(u'  <member type="%s" ref="%d" role=%s/>\n' % (m.type, m.ref, quoteattr(m.role)) for m in obj.members or ())
+        else:
+            raise Exception('Can\'t write %s as OSM XML' % kind.__name__)
+
+        lines.extend(u'  <tag k=%s v=%s/>\n' % (quoteattr(t.key), quoteattr(t.value)) for t in obj.tags or ())
+
+        if lines:
+            self._write(u' <%s%s>\n%s </%s>\n' % (tag, u''.join(attrs), u''.join(lines), tag))
+        else:
+            self._write(u' <%s%s/>\n' % (tag, u''.join(attrs)))
+
+    def close(self):
+        self._write(u'</osm>\n')
+        if self._owned:
+            self._file.close()
+
+## Extracts
+
+class _Region(object):
+    """One area being extracted and the ids of everything it keeps."""
+
+    def __init__(self, area, out):
+        if hasattr(area, 'bounds'):
+            # A Shapely polygon; check the bounding box first and only do the
+            # point-in-polygon test for nodes inside it.
+            from shapely.geometry import Point
+            from shapely.prepared import prep
+            self.bounds = tuple(area.bounds)
+            self._point = Point
+            self._prepared = prep(area)
+        else:
+            self.bounds = tuple(area)
+            self._prepared = None
+
+        self.out = out
+        self.inside = IdBitmap()
+        self.nodes = IdBitmap()
+        self.ways = IdBitmap()
+        self.relations = IdBitmap()
+        self.members = {'node': self.nodes, 'way': self.ways, 'relation': self.relations}
+
+    def contains(self, lon, lat):
+        min_lon, min_lat, max_lon, max_lat = self.bounds
+        if not (min_lon <= lon <= max_lon and min_lat <= lat <= max_lat):
+            return False
+        return self._prepared is None or self._prepared.contains(self._point(lon, lat))
+
+def _select(f, regions):
+    """First pass: work out which node, way and relation ids each region keeps."""
+
+    for obj in iter_osm_file(f, parse_timestamps=False, skip=('tags', 'metadata')):
+        kind = type(obj)
+        if kind is Node:
+            if obj.lat is None or obj.lon is None:
+                continue
+            for region in regions:
+                if region.contains(obj.lon, obj.lat):
+                    region.inside.add(obj.id)
+                    region.nodes.add(obj.id)
+        elif kind is Way:
+            for region in regions:
+                inside = region.inside
+                for ref in obj.nds:
+                    if ref in inside:
+                        region.ways.add(obj.id)
+                        region.nodes.update(obj.nds)
+                        break
+        elif kind is Relation:
+            for region in regions:
+                members = region.members
+                for member in obj.members:
+                    if member.ref in members[member.type]:
+                        region.relations.add(obj.id)
+                        break
+
+_KEPT = {
+    Node: 'nodes',
+    Way: 'ways',
+    Relation: 'relations',
+}
+
+def extract_regions(f, regions):
+    """Cut several extracts out of an OSM XML file at once. regions is a list
+    of (area, out) pairs, where area is a (min_lon, min_lat, max_lon, max_lat)
+    bounding box or a Shapely polygon and out is a filename or file-like to
+    write that extract to. See extract_bbox for what each extract contains.
+
+    The input is read twice no matter how many regions there are, so f must be
+    a filename or a seekable file. Kept ids are tracked in IdBitmaps."""
+
+    regions = [_Region(area, out) for area, out in regions]
+
+    if hasattr(f, 'read'):
+        position = f.tell()
+        _select(f, regions)
+        f.seek(position)
+    else:
+        _select(f, regions)
+
+    writers = []
+    for region in regions:
+        bounds = region.bounds if region._prepared is None else None
+        writers.append((region, OSMWriter(region.out, bounds)))
+
+    try:
+        for obj in iter_osm_file(f, parse_timestamps=False):
+            kept = _KEPT.get(type(obj))
+            if kept is None:
+                continue
+            for region, writer in writers:
+                if obj.id in getattr(region, kept):
+                    writer.write(obj)
+    finally:
+        for region, writer in writers:
+            writer.close()
+
+def extract_bbox(f, bbox, out):
+    """Write the part of an OSM XML file within bbox, a (min_lon, min_lat,
+    max_lon, max_lat) tuple or a Shapely polygon, to out.
+
+    The extract has every node inside the area, every way that uses one of
+    those nodes along with all of that way's nodes (so ways are complete), and
+    every relation with a kept node, way or relation as a member. Relations are
+    only matched against relations earlier in the file."""
+
+    extract_regions(f, [(bbox, out)])
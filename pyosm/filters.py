@@ -0,0 +1,85 @@
+"""Element filters that the parsers evaluate before building model objects.
+
+A filter has a `types` attribute (a set of element names like 'node' or 'way',
+or None for every type) and an `accepts(kind, tags)` method that is called with
+the element name and its list of Tags. Filters are plain objects rather than
+closures so that they can be shipped to worker processes."""
+
+class TagFilter(object):
+    """Accepts elements of the given types whose tags meet every condition:
+
+    keys            keys that must be present, with any value
+    values          dict of key -> collection of allowed values
+    exclude_keys    keys that must not be present
+    exclude_values  dict of key -> collection of values that reject the element
+
+    For example, TagFilter(types=['way'], keys=['highway'],
+    exclude_values={'highway': ['proposed']})"""
+
+    def __init__(self, types=None, keys=(), values=None, exclude_keys=(), exclude_values=None):
+        self.types = frozenset(types) if types is not None else None
+        self.keys = frozenset(keys)
+        self.values = dict((k, frozenset(v)) for k, v in (values or {}).items())
+        self.exclude_keys = frozenset(exclude_keys)
+        self.exclude_values = dict((k, frozenset(v)) for k, v in (exclude_values or {}).items())
+        self.needs_tags = bool(self.keys or self.values or self.exclude_keys or self.exclude_values)
+
+    def accepts(self, kind, tags):
+        if self.types is not None and kind not in self.types:
+            return False
+        if not self.needs_tags:
+            return True
+
+        tags = dict(tags)
+        for k in self.keys:
+            if k not in tags:
+                return False
+        for k, allowed in self.values.items():
+            if tags.get(k) not in allowed:
+                return False
+        for k in self.exclude_keys:
+            if k in tags:
+                return False
+        for k, rejected in self.exclude_values.items():
+            if tags.get(k) in rejected:
+                return False
+        return True
+
+def _union_types(filters):
+    types = set()
+    for f in filters:
+        if f.types is None:
+            return None
+        types |= f.types
+    return frozenset(types)
+
+class AnyOf(object):
+    """Accepts elements that are accepted by at least one of the given filters."""
+
+    def __init__(self, *filters):
+        self.filters = filters
+        self.types = _union_types(filters)
+        self.needs_tags = any(f.needs_tags for f in filters)
+
+    def accepts(self, kind, tags):
+        for f in self.filters:
+            if f.accepts(kind, tags):
+                return True
+        return False
+
+class AllOf(object):
+    """Accepts elements that are accepted by every one of the given filters."""
+
+    def __init__(self, *filters):
+        self.filters = filters
+        self.types = None
+        for f in filters:
+            if f.types is not None:
+                self.types = f.types if self.types is None else self.types & f.types
+        self.needs_tags = any(f.needs_tags for f in filters)
+
+    def accepts(self, kind, tags):
+        for f in self.filters:
+            if not f.accepts(kind, tags):
+                return False
+        return True
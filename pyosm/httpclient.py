@@ -0,0 +1,299 @@
+import random
+import socket
+import threading
+import time
+try:
+    import http.client as httplib
+    from urllib.parse import urlencode, urljoin, urlsplit
+except ImportError:
+    import httplib
+    from urllib import urlencode
+    from urlparse import urljoin, urlsplit
+
+# Every fetch in pyosm goes through an HTTPClient, which keeps idle keep-alive
+# connections per host so that repeated requests for state files, diffs and
+# API objects skip the TCP and TLS handshakes, and retries transient failures.
+
+USER_AGENT = 'pyosm/1.0 (http://github.com/iandees/pyosm)'
+
+# Responses that are worth trying again after a pause
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+class HTTPError(Exception):
+    """An HTTP error response. code is the status code."""
+
+    def __init__(self, url, code, reason):
+        super(HTTPError, self).__init__('HTTP %s %s for %s' % (code, reason, url))
+        self.url = url
+        self.code = code
+        self.reason = reason
+
+class Response(object):
+    """A file-like over a response body. Once the body has been read to the
+    end its connection goes back to the client's pool; closing it early
+    drops the connection instead. A body that ends before its Content-Length
+    raises httplib.IncompleteRead."""
+
+    def __init__(self, client, key, connection, response, url):
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self._client = client
+        self._key = key
+        self._connection = connection
+        self._response = response
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._response.read()
+        else:
+            data = self._response.read(size)
+            # httplib returns b'' rather than raising when the server closes
+            # the connection before sending Content-Length bytes.
+            length = self._response.length
+            if not data and size and length:
+                self._release(False)
+                raise httplib.IncompleteRead(b'', length)
+        if self._response.isclosed():
+            self._release(True)
+        return data
+
+    def close(self):
+        # Finish off short bodies, like error pages, so the connection can be
+        # used again rather than dropped.
+        length = getattr(self._response, 'length', None)
+        if not self._response.isclosed() and length is not None and length <= 65536:
+            try:
+                self._response.read()
+            except self._client._transient_errors:
+                pass
+        self._release(self._response.isclosed())
+        self._response.close()
+
+    def _release(self, reusable):
+        if self._connection is None:
+            return
+        if reusable and not self._response.will_close:
+            self._client._put_connection(self._key, self._connection)
+        else:
+            self._connection.close()
+        self._connection = None
+
+class _HTTPXResponse(object):
+    """Response's interface over a streamed httpx response."""
+
+    def __init__(self, response, url):
+        self.url = url
+        self.status = response.status_code
+        self.reason = response.reason_phrase
+        self._response = response
+        self._chunks = response.iter_raw()
+        self._buffer = b''
+
+    def getheader(self, name, default=None):
+        return self._response.headers.get(name, default)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._buffer + b''.join(self._chunks)
+            self._buffer = b''
+            return data
+
+        while not self._buffer:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return b''
+            self._buffer = chunk
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def close(self):
+        self._response.close()
+
+class HTTPClient(object):
+    """An HTTP client with a pool of keep-alive connections per host.
+
+    timeout is the socket timeout in seconds. Connection errors, timeouts and
+    the statuses in RETRY_STATUSES are retried up to retries times, waiting
+    backoff seconds and then twice as long each time (or as long as a
+    Retry-After header asks). Other error statuses raise HTTPError. At most
+    pool_size idle connections are kept per host.
+
+    http2=True sends requests through httpx with HTTP/2 enabled, which needs
+    httpx and its http2 extra to be installed."""
+
+    def __init__(self, timeout=30, retries=3, backoff=1.0, pool_size=10, user_agent=USER_AGENT, http2=False, max_redirects=5):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.user_agent = user_agent
+        self.max_redirects = max_redirects
+        self._pools = {}
+        self._lock = threading.Lock()
+
+        if http2:
+            try:
+                import httpx
+            except ImportError:
+                raise Exception('http2=True needs httpx to be installed')
+            self._httpx = httpx.Client(http2=True, timeout=timeout, limits=httpx.Limits(max_keepalive_connections=pool_size))
+            self._send = self._send_httpx
+            self._transient_errors = (httpx.TransportError,)
+        else:
+            self._httpx = None
+            self._send = self._send_httplib
+            self._transient_errors = (socket.error, httplib.HTTPException)
+
+    def get(self, url, params=None, headers=None):
+        return self.request('GET', url, params, headers)
+
+    def head(self, url, params=None, headers=None):
+        return self.request('HEAD', url, params, headers)
+
+    def request(self, method, url, params=None, headers=None, body=None):
+        """Make a request and return a file-like Response, following redirects
+        and retrying transient failures. Raises HTTPError for error statuses."""
+
+        if params:
+            url += ('&' if '?' in url else '?') + urlencode(params)
+
+        request_headers = {'User-Agent': self.user_agent}
+        if headers:
+            request_headers.update(headers)
+
+        for redirect in range(self.max_redirects + 1):
+            response = self._request_with_retries(method, url, request_headers, body)
+            location = response.getheader('Location')
+            if response.status in REDIRECT_STATUSES and location:
+                response.close()
+                url = urljoin(url, location)
+                if response.status == 303:
+                    method, body = 'GET', None
+                continue
+            if response.status >= 400:
+                response.close()
+                raise HTTPError(url, response.status, response.reason)
+            return response
+
+        raise HTTPError(url, response.status, 'Too many redirects')
+
+    def _request_with_retries(self, method, url, headers, body):
+        attempt = 0
+        while True:
+            try:
+                response = self._send(method, url, headers, body)
+            except _StaleConnection:
+                # The server dropped an idle keep-alive connection, which
+                # isn't a failure; just try again on a new one.
+                continue
+            except self._transient_errors:
+                if attempt >= self.retries:
+                    raise
+                time.sleep(self._delay(attempt))
+                attempt += 1
+                continue
+
+            if response.status in RETRY_STATUSES and attempt < self.retries:
+                delay = self._delay(attempt, response.getheader('Retry-After'))
+                response.close()
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            return response
+
+    def _delay(self, attempt, retry_after=None):
+        if retry_after is not None and retry_after.isdigit():
+            return int(retry_after)
+        # A little jitter keeps a pool of threads from retrying in lockstep
+        return self.backoff * (2 ** attempt) * random.uniform(0.75, 1.25)
+
+    def _send_httplib(self, method, url, headers, body):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        connection, reused = self._get_connection(key)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+        except self._transient_errors:
+            connection.close()
+            if reused:
+                raise _StaleConnection()
+            raise
+
+        result = Response(self, key, connection, response, url)
+        if method == 'HEAD':
+            # There's no body, so the connection can go straight back to the
+            # pool without waiting for the caller to read or close anything.
+            response.read()
+            result._release(True)
+        return result
+
+    def _send_httpx(self, method, url, headers, body):
+        request = self._httpx.build_request(method, url, headers=headers, content=body)
+        return _HTTPXResponse(self._httpx.send(request, stream=True), url)
+
+    def _get_connection(self, key):
+        with self._lock:
+            idle = self._pools.get(key)
+            if idle:
+                return idle.pop(), True
+
+        scheme, netloc = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout), False
+        if scheme == 'http':
+            return httplib.HTTPConnection(netloc, timeout=self.timeout), False
+        raise Exception('Unsupported URL scheme "%s"' % scheme)
+
+    def _put_connection(self, key, connection):
+        with self._lock:
+            idle = self._pools.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """Close every idle connection."""
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for idle in pools.values():
+            for connection in idle:
+                connection.close()
+        if self._httpx is not None:
+            self._httpx.close()
+
+class _StaleConnection(Exception):
+    pass
+
+_default_client = None
+
+def default_client():
+    """Return the HTTPClient used by pyosm's module-level functions."""
+    global _default_client
+    if _default_client is None:
+        _default_client = HTTPClient()
+    return _default_client
+
+def set_default_client(client):
+    """Use client for every fetch made by pyosm's module-level functions, for
+    example to change timeouts or retries or to enable HTTP/2."""
+    global _default_client
+    _default_client = client
+
+def get(url, params=None, headers=None):
+    return default_client().get(url, params, headers)
+
+def head(url, params=None, headers=None):
+    return default_client().head(url, params, headers)
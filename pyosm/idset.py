@@ -0,0 +1,49 @@
+class IdBitmap(object):
+    """A set of non-negative integer ids stored as one bit per possible id. For
+    the dense id spaces in OSM data this takes far less memory than a Python set
+    (about 1.5 GB covers every node id in the planet, rather than tens of GB).
+    Negative ids, which only appear in unsaved editor data, are kept in a
+    regular set."""
+
+    def __init__(self, ids=()):
+        self._bits = bytearray()
+        self._count = 0
+        self._negative = set()
+        self.update(ids)
+
+    def __len__(self):
+        return self._count + len(self._negative)
+
+    def add(self, i):
+        if i < 0:
+            self._negative.add(i)
+            return
+
+        byte = i >> 3
+        bits = self._bits
+        if byte >= len(bits):
+            # Grow geometrically so that adding ascending ids stays cheap
+            bits.extend(bytearray(max(byte + 1 - len(bits), len(bits))))
+        mask = 1 << (i & 7)
+        if not bits[byte] & mask:
+            bits[byte] |= mask
+            self._count += 1
+
+    def update(self, ids):
+        for i in ids:
+            self.add(i)
+
+    def __contains__(self, i):
+        if i < 0:
+            return i in self._negative
+        byte = i >> 3
+        return byte < len(self._bits) and bool(self._bits[byte] & (1 << (i & 7)))
+
+    def __iter__(self):
+        for i in sorted(self._negative):
+            yield i
+        for byte, value in enumerate(self._bits):
+            if value:
+                for bit in range(8):
+                    if value & (1 << bit):
+                        yield (byte << 3) | bit
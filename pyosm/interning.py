@@ -0,0 +1,62 @@
+class _FrequencyTable(object):
+    """A bounded intern table that remembers how often each string was seen.
+    When it fills up, the less popular half is dropped and the remaining
+    counts are halved so that strings which stop appearing eventually age out."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.strings = {}
+        self.counts = {}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def intern(self, s):
+        shared = self.strings.get(s)
+        if shared is not None:
+            self.counts[shared] += 1
+            return shared
+
+        if len(self.strings) >= self.max_size:
+            self._evict()
+        self.strings[s] = s
+        self.counts[s] = 1
+        return s
+
+    def _evict(self):
+        by_count = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        keep = by_count[:self.max_size // 2]
+        self.strings = dict((s, s) for s, count in keep)
+        self.counts = dict((s, count // 2 + 1) for s, count in keep)
+
+class StringInterner(object):
+    """Shares a single string object between repeated tag keys, tag values and
+    user names so that parsed data held in memory doesn't keep millions of
+    copies of 'highway' or 'residential' around.
+
+    Keys come from a small vocabulary, so they go into a plain table that stops
+    growing once it has max_keys entries. Values and user names have a long
+    tail, so they go into frequency-aware tables that keep the most commonly
+    seen max_values/max_users strings."""
+
+    def __init__(self, max_keys=200000, max_values=1000000, max_users=1000000):
+        self.max_keys = max_keys
+        self.keys = {}
+        self.values = _FrequencyTable(max_values)
+        self.users = _FrequencyTable(max_users)
+
+    def key(self, s):
+        shared = self.keys.get(s)
+        if shared is not None:
+            return shared
+        if len(self.keys) < self.max_keys:
+            self.keys[s] = s
+        return s
+
+    def value(self, s):
+        return self.values.intern(s)
+
+    def user(self, s):
+        if s is None:
+            return s
+        return self.users.intern(s)
@@ -1,3 +1,4 @@
+import array
 import collections
 
 ## OSM Objects
@@ -14,3 +15,128 @@ Comment = collections.namedtuple('Comment', 'created_at, user, uid, action, text
 
 ## pyosm Metadata
 Finished = collections.namedtuple('Finished', 'sequence, timestamp')
+
+## Compact OSM Objects
+# Memory-efficient alternatives to Node, Way and Relation with the same
+# attribute names. Coordinates are int32 fixed-point (1e-7 degree) packed into
+# a single int, tags are a flat tuple of alternating keys and values, and way
+# node refs are an array of int64s. Tags and members are unpacked into Tag and
+# Member lists on access.
+try:
+    array.array('q')
+    ID_TYPECODE = 'q'
+except ValueError:
+    ID_TYPECODE = 'l'
+
+_NO_TAGS = ()
+
+def packLocation(lat, lon):
+    """Pack a lat/lon pair into a single int of two int32 fixed-point values."""
+    if lat is None or lon is None:
+        return None
+    return (int(round(lat * 1e7)) << 32) | (int(round(lon * 1e7)) & 0xffffffff)
+
+def packTags(pairs):
+    """Pack a flat list of alternating keys and values for compact storage."""
+    return tuple(pairs) if pairs else _NO_TAGS
+
+def _unpackTags(packed):
+    if packed is None:
+        return None
+    return [Tag(packed[i], packed[i + 1]) for i in range(0, len(packed), 2)]
+
+class _Compact(object):
+    __slots__ = ()
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (f, getattr(self, f)) for f in self._fields))
+
+    def __eq__(self, other):
+        return type(self) == type(other) and all(getattr(self, f) == getattr(other, f) for f in self._fields)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        # Hash the packed values, which equal objects share. Way node refs are
+        # an array and packed values may be lists, so those hash as tuples.
+        return hash(tuple(tuple(v) if isinstance(v, (list, array.array)) else v for v in self.__getstate__()))
+
+    def __getstate__(self):
+        return tuple(getattr(self, s) for s in self.__slots__)
+
+    def __setstate__(self, state):
+        for s, v in zip(self.__slots__, state):
+            setattr(self, s, v)
+
+    @property
+    def tags(self):
+        return _unpackTags(self.packed_tags)
+
+class CompactNode(_Compact):
+    __slots__ = ('id', 'version', 'changeset', 'user', 'uid', 'visible', 'timestamp', 'loc', 'packed_tags')
+    _fields = Node._fields
+
+    def __init__(self, id, version, changeset, user, uid, visible, timestamp, loc, packed_tags):
+        self.id = id
+        self.version = version
+        self.changeset = changeset
+        self.user = user
+        self.uid = uid
+        self.visible = visible
+        self.timestamp = timestamp
+        self.loc = loc
+        self.packed_tags = packed_tags
+
+    @property
+    def lat(self):
+        if self.loc is None:
+            return None
+        return (self.loc >> 32) / 1e7
+
+    @property
+    def lon(self):
+        if self.loc is None:
+            return None
+        lon = self.loc & 0xffffffff
+        if lon >= 0x80000000:
+            lon -= 0x100000000
+        return lon / 1e7
+
+class CompactWay(_Compact):
+    __slots__ = ('id', 'version', 'changeset', 'user', 'uid', 'visible', 'timestamp', 'nds', 'packed_tags')
+    _fields = Way._fields
+
+    def __init__(self, id, version, changeset, user, uid, visible, timestamp, nds, packed_tags):
+        self.id = id
+        self.version = version
+        self.changeset = changeset
+        self.user = user
+        self.uid = uid
+        self.visible = visible
+        self.timestamp = timestamp
+        self.nds = nds
+        self.packed_tags = packed_tags
+
+class CompactRelation(_Compact):
+    __slots__ = ('id', 'version', 'changeset', 'user', 'uid', 'visible', 'timestamp', 'packed_members', 'packed_tags')
+    _fields = Relation._fields
+
+    def __init__(self, id, version, changeset, user, uid, visible, timestamp, packed_members, packed_tags):
+        self.id = id
+        self.version = version
+        self.changeset = changeset
+        self.user = user
+        self.uid = uid
+        self.visible = visible
+        self.timestamp = timestamp
+        self.packed_members = packed_members
+        self.packed_tags = packed_tags
+
+    @property
+    def members(self):
+        """Members are packed as a flat tuple of (type, ref, role) triples."""
+        packed = self.packed_members
+        if packed is None:
+            return None
+        return [Member(packed[i], packed[i + 1], packed[i + 2]) for i in range(0, len(packed), 3)]
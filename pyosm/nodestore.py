@@ -0,0 +1,160 @@
+import array
+import bisect
+import mmap
+import os
+import struct
+import tempfile
+from pyosm.model import ID_TYPECODE
+
+# Node location stores map node ids to (lon, lat) tuples with the same
+# __setitem__/get interface as a dict, so shapeify can use any of them. The
+# compact stores keep coordinates as 1e-7 degree fixed point, which is the
+# precision OSM itself uses, so locations come back exactly as they went in.
+
+def _toFixed(lon, lat):
+    """Encode a location as two unsigned ints, offset so that (0, 0) means 'no location'."""
+    return int(round(lon * 1e7)) + 0x80000000, int(round(lat * 1e7)) + 0x80000000
+
+def _fromFixed(lon, lat):
+    return (lon - 0x80000000) / 1e7, (lat - 0x80000000) / 1e7
+
+class DictNodeStore(dict):
+    """Keeps locations in a Python dict. Fast, but roughly 150 bytes per node."""
+
+    def close(self):
+        self.clear()
+
+class DenseNodeStore(object):
+    """Keeps locations in a memory-mapped file indexed directly by node id, using
+    8 bytes per possible id. The file is sparse, so only pages that actually hold
+    locations use disk or memory, which makes this the right choice for planet
+    sized inputs. If no path is given a temporary file is used and removed when
+    the store is closed."""
+
+    _record = struct.Struct('<II')
+
+    def __init__(self, path=None, initial_ids=1 << 20):
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='pyosm-nodes-')
+            os.close(fd)
+            self._temporary = True
+        else:
+            self._temporary = False
+
+        self.path = path
+        self._file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        self._capacity = 0
+        self._map = None
+        self._resize(max(initial_ids, os.path.getsize(path) // 8))
+
+    def _resize(self, ids):
+        if self._map is not None:
+            self._map.close()
+        self._file.truncate(ids * 8)
+        self._capacity = ids
+        self._map = mmap.mmap(self._file.fileno(), ids * 8)
+
+    def __setitem__(self, node_id, location):
+        if node_id < 0:
+            raise Exception('DenseNodeStore can\'t store negative node id %s' % node_id)
+        if node_id >= self._capacity:
+            self._resize(max(node_id + 1, self._capacity * 2))
+        self._record.pack_into(self._map, node_id * 8, *_toFixed(*location))
+
+    def get(self, node_id, default=None):
+        if node_id < 0 or node_id >= self._capacity:
+            return default
+        lon, lat = self._record.unpack_from(self._map, node_id * 8)
+        if not lon and not lat:
+            return default
+        return _fromFixed(lon, lat)
+
+    def __getitem__(self, node_id):
+        location = self.get(node_id)
+        if location is None:
+            raise KeyError(node_id)
+        return location
+
+    def __contains__(self, node_id):
+        return self.get(node_id) is not None
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._file.close()
+            if self._temporary:
+                os.remove(self.path)
+
+class SparseNodeStore(object):
+    """Keeps locations in parallel arrays sorted by node id, using 16 bytes per
+    stored node, and looks them up with a binary search. This suits
+    extracts, where the ids are too spread out for DenseNodeStore. Ids are
+    expected in increasing order, as they are in OSM files; if they aren't the
+    arrays are sorted before the next lookup."""
+
+    def __init__(self):
+        self._ids = array.array(ID_TYPECODE)
+        self._lons = array.array('i')
+        self._lats = array.array('i')
+        self._sorted = True
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __setitem__(self, node_id, location):
+        if self._ids and node_id <= self._ids[-1]:
+            self._sorted = False
+        lon, lat = location
+        self._ids.append(node_id)
+        self._lons.append(int(round(lon * 1e7)))
+        self._lats.append(int(round(lat * 1e7)))
+
+    def _sort(self):
+        # A stable sort keeps duplicates in the order they were stored
+        order = sorted(range(len(self._ids)), key=self._ids.__getitem__)
+        self._ids = array.array(ID_TYPECODE, (self._ids[i] for i in order))
+        self._lons = array.array('i', (self._lons[i] for i in order))
+        self._lats = array.array('i', (self._lats[i] for i in order))
+        self._sorted = True
+
+    def get(self, node_id, default=None):
+        if not self._sorted:
+            self._sort()
+        ids = self._ids
+        # Search from the right so that the most recently stored duplicate wins
+        i = bisect.bisect_right(ids, node_id) - 1
+        if i < 0 or ids[i] != node_id:
+            return default
+        return self._lons[i] / 1e7, self._lats[i] / 1e7
+
+    def __getitem__(self, node_id):
+        location = self.get(node_id)
+        if location is None:
+            raise KeyError(node_id)
+        return location
+
+    def __contains__(self, node_id):
+        return self.get(node_id) is not None
+
+    def close(self):
+        self._ids = array.array(ID_TYPECODE)
+        self._lons = array.array('i')
+        self._lats = array.array('i')
+
+NODE_STORES = {
+    'dict': DictNodeStore,
+    'dense': DenseNodeStore,
+    'sparse': SparseNodeStore,
+}
+
+def make_node_store(node_store):
+    """Return a node store for a store name from NODE_STORES, an existing store
+    instance, or None (which means 'dict')."""
+    if node_store is None:
+        return DictNodeStore()
+    if isinstance(node_store, str):
+        if node_store not in NODE_STORES:
+            raise Exception('Unknown node store "%s"' % node_store)
+        return NODE_STORES[node_store]()
+    return node_store
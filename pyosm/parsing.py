@@ -1,24 +1,81 @@
+import pyosm.httpclient as httpclient
 import pyosm.model as model
+from pyosm.cache import CacheMiss
 import datetime
-try:
-    import urllib.request as urllib2
-except ImportError:
-    import urllib2
-try:
-    import StringIO
-except ImportError:
-    from io import StringIO
-import gzip
+import array
+import bz2
+import calendar
+import email.utils
+import io
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import re
 import time
 import os.path
+import zlib
 from lxml import etree
+from pyosm.workers import imap_bounded
+
+# Replication diffs repeat the same handful of timestamps over and over, so
+# parsed values are cached by their raw string. The caches are simply emptied
+# when they fill up, which keeps them bounded without any bookkeeping.
+_TIMESTAMP_CACHE_SIZE = 8192
+_datetime_cache = {}
+_epoch_cache = {}
+
+def _isoFields(s):
+    """Split a YYYY-MM-DDTHH:MM:SSZ string into its integer fields."""
+    if len(s) == 20 and s[4] == '-' and s[7] == '-' and s[10] == 'T' and s[13] == ':' and s[16] == ':' and s[19] == 'Z':
+        return int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19])
+    return datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%SZ").timetuple()[:6]
 
 def isoToDatetime(s):
     """Parse a ISO8601-formatted string to a Python datetime."""
     if s is None:
         return s
+
+    dt = _datetime_cache.get(s)
+    if dt is None:
+        dt = datetime.datetime(*_isoFields(s))
+        if len(_datetime_cache) >= _TIMESTAMP_CACHE_SIZE:
+            _datetime_cache.clear()
+        _datetime_cache[s] = dt
+    return dt
+
+def isoToEpoch(s):
+    """Parse a ISO8601-formatted string to integer seconds since the Unix epoch."""
+    if s is None:
+        return s
+
+    epoch = _epoch_cache.get(s)
+    if epoch is None:
+        year, month, day, hour, minute, second = _isoFields(s)
+        # Days since 1970-01-01 in the proleptic Gregorian calendar
+        y = year - (month <= 2)
+        era = y // 400
+        yoe = y - era * 400
+        doy = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+        doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+        days = era * 146097 + doe - 719468
+        epoch = days * 86400 + hour * 3600 + minute * 60 + second
+        if len(_epoch_cache) >= _TIMESTAMP_CACHE_SIZE:
+            _epoch_cache.clear()
+        _epoch_cache[s] = epoch
+    return epoch
+
+def _noConversion(s):
+    return s
+
+def _timestampConverter(parse_timestamps):
+    """Return the function that converts raw timestamp strings for the given
+    parse_timestamps option: True for datetimes, 'epoch' for integer seconds
+    since the Unix epoch, or False to leave them as strings."""
+    if parse_timestamps == 'epoch':
+        return isoToEpoch
+    elif parse_timestamps:
+        return isoToDatetime
     else:
-        return datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%SZ")
+        return _noConversion
 
 def noteTimeToDatetime(s):
     """Parse a datetime out of the Notes RSS feed."""
@@ -50,9 +107,466 @@ def readState(state_file, sep='='):
 
     return state
 
-def iter_changeset_stream(start_sqn=None, base_url='https://planet.openstreetmap.org/replication/changesets', expected_interval=60, parse_timestamps=True, state_dir=None):
+class _DecompressingReader(object):
+    """A read-only file-like that decompresses gzip (including multi-member
+    files) or bz2 data from another file-like, such as an HTTP response, a
+    block at a time as it is read. Only one block of compressed data and its
+    decompressed output are held in memory. Like a raw stream, read(size) may
+    return less than size bytes; it returns b'' at the end of the data. Like
+    gzip.GzipFile, it raises EOFError if the data ends part way through a
+    compressed member. on_end is called, if given, once the data has ended
+    cleanly."""
+
+    def __init__(self, fileobj, compression='gzip', block_size=65536, on_end=None):
+        if compression not in ('gzip', 'bz2'):
+            raise Exception('Unknown compression "%s"' % compression)
+        self._fileobj = fileobj
+        self._compression = compression
+        self._block_size = block_size
+        self._on_end = on_end
+        self._decompressor = self._new_decompressor()
+        self._in_member = False
+        self._buffer = b''
+        self._offset = 0
+        self._eof = False
+
+    def _new_decompressor(self):
+        if self._compression == 'bz2':
+            return bz2.BZ2Decompressor()
+        # 16 + MAX_WBITS makes zlib expect a gzip header and trailer
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def _decompress_block(self):
+        """Decompress the next block of input, returning b'' at the end."""
+        data = self._fileobj.read(self._block_size)
+        if not data:
+            self._eof = True
+            if self._in_member:
+                raise EOFError('Compressed data ended before the end-of-stream marker was reached')
+            if self._on_end is not None:
+                self._on_end()
+            return b''
+
+        output = []
+        while data:
+            decompressor = self._decompressor
+            output.append(decompressor.decompress(data))
+            # Decompressors without an eof attribute (Python 2) can't tell
+            # whether a member is complete, so truncation goes unnoticed there.
+            self._in_member = hasattr(decompressor, 'eof') and not decompressor.eof
+            # Anything after the end of a member is the start of the next one
+            data = decompressor.unused_data
+            if data or getattr(decompressor, 'eof', False):
+                self._decompressor = self._new_decompressor()
+                self._in_member = False
+        return b''.join(output)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            output = [self._buffer[self._offset:]]
+            while not self._eof:
+                output.append(self._decompress_block())
+            self._buffer = b''
+            self._offset = 0
+            return b''.join(output)
+
+        # Hand out the decompressed block in pieces without copying the rest
+        if self._offset >= len(self._buffer):
+            self._buffer = b''
+            self._offset = 0
+            while not self._buffer and not self._eof:
+                self._buffer = self._decompress_block()
+        data = self._buffer[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
+
+    def close(self):
+        self._fileobj.close()
+
+def _open_url(url, cache=None):
+    """Open a URL through a pyosm.cache.DiskCache if one is given."""
+    return cache.open(url) if cache is not None else httpclient.get(url)
+
+def _urlopen_decompressed(url, cache=None):
+    """Open a .gz or .bz2 URL and return a file-like of its decompressed
+    contents, which are decompressed as the response is read."""
+    compression = 'bz2' if url.endswith('.bz2') else 'gzip'
+    if cache is None:
+        return _DecompressingReader(httpclient.get(url), compression)
+    # Only cache a download once it has decompressed to the end
+    f = cache.open(url, complete_on_eof=False)
+    return _DecompressingReader(f, compression, on_end=getattr(f, 'complete', None))
+
+def _iter_download(url, cache, parse, args, content=None):
+    """Yield what parse(content, *args) yields for the decompressed contents
+    of url (or of content, if it has already been opened), closing it when
+    done. Opening it only covers the response headers, so if the connection
+    fails or the download turns out to be truncated while the body is being
+    read, it is downloaded again with the client's retries and backoff.
+
+    That is only done while nothing has been yielded yet. The parsers pass
+    objects on as soon as they are complete, so after that a retry would hand
+    the caller some of them twice, and the error is raised instead."""
+
+    client = httpclient.default_client()
+    errors = client._transient_errors + (EOFError,)
+    attempt = 0
+    while True:
+        if content is None:
+            content = _urlopen_decompressed(url, cache)
+        yielded = False
+        try:
+            for obj in parse(content, *args):
+                yielded = True
+                yield obj
+            return
+        except errors:
+            if yielded or attempt >= client.retries:
+                raise
+        finally:
+            # Stopping part way through leaves the download unfinished, and
+            # closing it keeps a partial file out of the cache.
+            content.close()
+            content = None
+
+        time.sleep(client._delay(attempt))
+        attempt += 1
+
+# Fields that the parsers can be asked not to build. Skipped fields come back
+# as None, and none of the work to convert or allocate them is done.
+SKIP_FIELDS = ('tags', 'metadata', 'nds', 'members')
+
+_NO_METADATA = (None, None, None, None, None, None)
+
+def _metadata(target, attrib):
+    """Return (version, changeset, user, uid, visible, timestamp) for an element."""
+    if target.skip_metadata:
+        return _NO_METADATA
+
+    return (
+        maybeInt(attrib.get('version')),
+        maybeInt(attrib.get('changeset')),
+        target.user(attrib.get('user')),
+        maybeInt(attrib.get('uid')),
+        maybeBool(attrib.get('visible')),
+        target.timestamp(attrib.get('timestamp')),
+    )
+
+def _build_node(target, attrib):
+    version, changeset, user, uid, visible, timestamp = _metadata(target, attrib)
+    return model.Node(
+        int(attrib['id']),
+        version,
+        changeset,
+        user,
+        uid,
+        visible,
+        timestamp,
+        maybeFloat(attrib.get('lat')),
+        maybeFloat(attrib.get('lon')),
+        target.tags
+    )
+
+def _build_way(target, attrib):
+    version, changeset, user, uid, visible, timestamp = _metadata(target, attrib)
+    return model.Way(
+        int(attrib['id']),
+        version,
+        changeset,
+        user,
+        uid,
+        visible,
+        timestamp,
+        target.nds,
+        target.tags
+    )
+
+def _build_relation(target, attrib):
+    version, changeset, user, uid, visible, timestamp = _metadata(target, attrib)
+    return model.Relation(
+        int(attrib['id']),
+        version,
+        changeset,
+        user,
+        uid,
+        visible,
+        timestamp,
+        target.members,
+        target.tags
+    )
+
+def _build_changeset(target, attrib):
+    if target.skip_metadata:
+        created_at = closed_at = is_open = user = uid = None
+    else:
+        created_at = target.timestamp(attrib.get('created_at'))
+        closed_at = target.timestamp(attrib.get('closed_at'))
+        is_open = maybeBool(attrib['open'])
+        user = target.user(attrib.get('user'))
+        uid = maybeInt(attrib.get('uid'))
+
+    return model.Changeset(
+        int(attrib['id']),
+        created_at,
+        closed_at,
+        is_open,
+        maybeFloat(attrib.get('min_lat')),
+        maybeFloat(attrib.get('max_lat')),
+        maybeFloat(attrib.get('min_lon')),
+        maybeFloat(attrib.get('max_lon')),
+        user,
+        uid,
+        target.tags
+    )
+
+def _packed(values):
+    return model.packTags(values) if values is not None else None
+
+def _build_compact_node(target, attrib):
+    version, changeset, user, uid, visible, timestamp = _metadata(target, attrib)
+    return model.CompactNode(
+        int(attrib['id']),
+        version,
+        changeset,
+        user,
+        uid,
+        visible,
+        timestamp,
+        model.packLocation(maybeFloat(attrib.get('lat')), maybeFloat(attrib.get('lon'))),
+        _packed(target.tags)
+    )
+
+def _build_compact_way(target, attrib):
+    version, changeset, user, uid, visible, timestamp = _metadata(target, attrib)
+    return model.CompactWay(
+        int(attrib['id']),
+        version,
+        changeset,
+        user,
+        uid,
+        visible,
+        timestamp,
+        target.nds,
+        _packed(target.tags)
+    )
+
+def _build_compact_relation(target, attrib):
+    version, changeset, user, uid, visible, timestamp = _metadata(target, attrib)
+    return model.CompactRelation(
+        int(attrib['id']),
+        version,
+        changeset,
+        user,
+        uid,
+        visible,
+        timestamp,
+        _packed(target.members),
+        _packed(target.tags)
+    )
+
+# Top-level OSM elements and the functions that turn their attributes and
+# collected children into model objects.
+_ELEMENT_BUILDERS = {
+    'node': _build_node,
+    'way': _build_way,
+    'relation': _build_relation,
+    'changeset': _build_changeset,
+}
+
+_COMPACT_BUILDERS = {
+    'node': _build_compact_node,
+    'way': _build_compact_way,
+    'relation': _build_compact_relation,
+    'changeset': _build_changeset,
+}
+
+_ACTIONS = ('create', 'modify', 'delete')
+
+class _OSMTarget(object):
+    """An lxml parser target that builds model objects directly from start/end
+    callbacks, so no element tree is ever built or pruned. Finished objects are
+    collected as (action, obj) tuples in self.objects for the caller to drain."""
+
+    def __init__(self, parse_timestamps=True, skip=(), element_filter=None, keep_nodes=None, interner=None, compact=False):
+        for field in skip:
+            if field not in SKIP_FIELDS:
+                raise Exception('Unknown field to skip "%s"' % field)
+
+        self.timestamp = _timestampConverter(parse_timestamps)
+        self.skip_metadata = 'metadata' in skip
+        self.return_tags = 'tags' not in skip
+        self.keep_tags = self.return_tags or (element_filter is not None and element_filter.needs_tags)
+        self.keep_nds = 'nds' not in skip
+        self.keep_members = 'members' not in skip
+        self.element_filter = element_filter
+        self.keep_nodes = keep_nodes
+        self.user = _noConversion if interner is None else interner.user
+        self.compact = compact
+        self.builders = _COMPACT_BUILDERS if compact else _ELEMENT_BUILDERS
+        self.objects = []
+        self.action = None
+        self.attrib = None
+        self.tags = None
+        self.nds = None
+        self.members = None
+
+        self._starts = {}
+        if self.keep_tags:
+            if interner is not None:
+                self.intern_key = interner.key
+                self.intern_value = interner.value
+            if compact:
+                self._starts['tag'] = self._start_packed_tag if interner is None else self._start_interned_packed_tag
+            else:
+                self._starts['tag'] = self._start_tag if interner is None else self._start_interned_tag
+        if self.keep_nds:
+            self._starts['nd'] = self._start_nd
+        if self.keep_members:
+            self._starts['member'] = self._start_packed_member if compact else self._start_member
+        self._ends = {}
+        for tag in _ELEMENT_BUILDERS:
+            self._starts[tag] = self._start_element
+            self._ends[tag] = self._end_element
+        for tag in _ACTIONS:
+            self._starts[tag] = self._start_action
+            self._ends[tag] = self._end_action
+
+        # While inside an element whose type the filter rejects, dispatch
+        # through a table that ignores its children entirely.
+        self._element_starts = self._starts
+        self._skipping_starts = dict((tag, self._starts[tag]) for tag in _ELEMENT_BUILDERS)
+        for tag in _ACTIONS:
+            self._skipping_starts[tag] = self._start_action
+
+        self.types = None
+        if element_filter is not None and element_filter.types is not None:
+            self.types = set(element_filter.types)
+            if keep_nodes is not None:
+                self.types.add('node')
+
+    def start(self, tag, attrib):
+        handler = self._starts.get(tag)
+        if handler is not None:
+            handler(tag, attrib)
+
+    def end(self, tag):
+        handler = self._ends.get(tag)
+        if handler is not None:
+            handler(tag)
+
+    def close(self):
+        pass
+
+    def _start_element(self, tag, attrib):
+        if self.types is not None and tag not in self.types:
+            self.attrib = None
+            self._starts = self._skipping_starts
+            return
+
+        self._starts = self._element_starts
+        self.attrib = attrib
+        self.tags = [] if self.keep_tags else None
+        if not self.keep_nds:
+            self.nds = None
+        elif self.compact:
+            self.nds = array.array(model.ID_TYPECODE)
+        else:
+            self.nds = []
+        self.members = [] if self.keep_members else None
+
+    def _start_tag(self, tag, attrib):
+        self.tags.append(model.Tag(attrib['k'], attrib['v']))
+
+    def _start_interned_tag(self, tag, attrib):
+        self.tags.append(model.Tag(self.intern_key(attrib['k']), self.intern_value(attrib['v'])))
+
+    def _start_packed_tag(self, tag, attrib):
+        self.tags.append(attrib['k'])
+        self.tags.append(attrib['v'])
+
+    def _start_interned_packed_tag(self, tag, attrib):
+        self.tags.append(self.intern_key(attrib['k']))
+        self.tags.append(self.intern_value(attrib['v']))
+
+    def _start_nd(self, tag, attrib):
+        self.nds.append(int(attrib['ref']))
+
+    def _start_member(self, tag, attrib):
+        self.members.append(model.Member(attrib['type'], int(attrib['ref']), attrib['role']))
+
+    def _start_packed_member(self, tag, attrib):
+        self.members.append(attrib['type'])
+        self.members.append(int(attrib['ref']))
+        self.members.append(attrib['role'])
+
+    def _start_action(self, tag, attrib):
+        self.action = tag
+
+    def _end_element(self, tag):
+        if self.attrib is None:
+            self._starts = self._element_starts
+            return
+
+        if self.element_filter is not None and not self._accepts(tag):
+            self.attrib = self.tags = self.nds = self.members = None
+            return
+
+        if not self.return_tags:
+            self.tags = None
+
+        obj = self.builders[tag](self, self.attrib)
+        self.objects.append((self.action, obj))
+        self.attrib = self.tags = self.nds = self.members = None
+
+    def _accepts(self, tag):
+        tags = self.tags
+        if self.compact and tags is not None:
+            tags = zip(tags[0::2], tags[1::2])
+        if self.element_filter.accepts(tag, tags):
+            return True
+        # Nodes that kept ways refer to are kept regardless of their tags
+        return tag == 'node' and self.keep_nodes is not None and int(self.attrib['id']) in self.keep_nodes
+
+    def _end_action(self, tag):
+        self.action = None
+
+def _iter_parse(f, target, chunk_size=65536):
+    """Feed a file-like or filename through an lxml parser with the given
+    target, yielding the target's finished objects as they become available."""
+
+    if not hasattr(f, 'read'):
+        with open(f, 'rb') as fp:
+            for obj in _iter_parse(fp, target, chunk_size):
+                yield obj
+        return
+
+    parser = etree.XMLParser(target=target)
+    objects = target.objects
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        parser.feed(data)
+
+        if objects:
+            for obj in objects:
+                yield obj
+            del objects[:]
+
+    parser.close()
+    for obj in objects:
+        yield obj
+    del objects[:]
+
+def iter_changeset_stream(start_sqn=None, base_url='https://planet.openstreetmap.org/replication/changesets', expected_interval=60, parse_timestamps=True, state_dir=None, start_time=None, cache=None):
     """Start processing an OSM changeset stream and yield one (action, primitive) tuple
-    at a time to the caller."""
+    at a time to the caller. Pass start_time (a UTC datetime) instead of
+    start_sqn to start from the first diff after that time; see
+    find_sequence_for_timestamp.
+
+    cache is an optional pyosm.cache.DiskCache that diffs are read from and
+    saved to. If it is offline the stream ends at the first diff it doesn't
+    have."""
 
     # This is a lot like the other osm_stream except there's no
     # state file for each of the diffs, so just push ahead until
@@ -68,10 +582,12 @@ def iter_changeset_stream(start_sqn=None, base_url='https://planet.openstreetmap
                 state = readState(f, ': ')
                 start_sqn = state['sequence']
 
+    if not start_sqn and start_time is not None:
+        start_sqn = find_sequence_for_timestamp(base_url, start_time)
+
     # If no start_sqn, assume to start from the most recent changeset file
     if not start_sqn:
-        u = urllib2.urlopen('%s/state.yaml' % base_url)
-        state = readState(u, ': ')
+        state_text, state = _fetch_state('%s/state.yaml' % base_url, ': ')
         sequenceNumber = int(state['sequence'])
     else:
         sequenceNumber = int(start_sqn)
@@ -84,45 +600,23 @@ def iter_changeset_stream(start_sqn=None, base_url='https://planet.openstreetmap
         delay = 1.0
         while True:
             try:
-                content = urllib2.urlopen(url)
-                content = StringIO.StringIO(content.read())
-                gzipper = gzip.GzipFile(fileobj=content)
+                content = _urlopen_decompressed(url, cache)
                 interval_fudge -= (interval_fudge / 2.0)
                 break
-            except urllib2.HTTPError as e:
+            except CacheMiss:
+                return
+            except httpclient.HTTPError as e:
                 if e.code == 404:
                     time.sleep(delay)
                     delay = min(delay * 2, 13)
                     interval_fudge += delay
 
-        obj = None
-        for event, elem in etree.iterparse(gzipper, events=('start', 'end')):
-            if event == 'start':
-                if elem.tag == 'changeset':
-                    obj = model.Changeset(
-                        int(elem.attrib['id']),
-                        isoToDatetime(elem.attrib.get('created_at')) if parse_timestamps else elem.attrib.get('created_at'),
-                        isoToDatetime(elem.attrib.get('closed_at')) if parse_timestamps else elem.attrib.get('closed_at'),
-                        maybeBool(elem.attrib['open']),
-                        maybeFloat(elem.get('min_lat')),
-                        maybeFloat(elem.get('max_lat')),
-                        maybeFloat(elem.get('min_lon')),
-                        maybeFloat(elem.get('max_lon')),
-                        elem.attrib.get('user'),
-                        maybeInt(elem.attrib.get('uid')),
-                        []
-                    )
-                elif elem.tag == 'tag':
-                    obj.tags.append(
-                        model.Tag(
-                            elem.attrib['k'],
-                            elem.attrib['v']
-                        )
-                    )
-            elif event == 'end':
-                if elem.tag == 'changeset':
-                    yield obj
-                    obj = None
+        changesets = _iter_download(url, cache, iter_osm_file, (parse_timestamps,), content)
+        try:
+            for obj in changesets:
+                yield obj
+        finally:
+            changesets.close()
 
         yield model.Finished(sequenceNumber, None)
 
@@ -132,87 +626,81 @@ def iter_changeset_stream(start_sqn=None, base_url='https://planet.openstreetmap
             with open('%s/state.yaml' % state_dir, 'w') as f:
                 f.write('sequence: %d' % sequenceNumber)
 
-def iter_osm_change_file(f, parse_timestamps=True):
-    action = None
-    obj = None
-    for event, elem in etree.iterparse(f, events=('start', 'end')):
-        if event == 'start':
-            if elem.tag == 'node':
-                obj = model.Node(
-                    int(elem.attrib['id']),
-                    int(elem.attrib['version']),
-                    int(elem.attrib['changeset']),
-                    elem.attrib.get('user'),
-                    maybeInt(elem.attrib.get('uid')),
-                    maybeBool(elem.attrib.get('visible')),
-                    isoToDatetime(elem.attrib.get('timestamp')) if parse_timestamps else elem.attrib.get('timestamp'),
-                    maybeFloat(elem.attrib.get('lat')),
-                    maybeFloat(elem.attrib.get('lon')),
-                    []
-                )
-            elif elem.tag == 'way':
-                obj = model.Way(
-                    int(elem.attrib['id']),
-                    int(elem.attrib['version']),
-                    int(elem.attrib['changeset']),
-                    elem.attrib.get('user'),
-                    maybeInt(elem.attrib.get('uid')),
-                    maybeBool(elem.attrib.get('visible')),
-                    isoToDatetime(elem.attrib.get('timestamp')) if parse_timestamps else elem.attrib.get('timestamp'),
-                    [],
-                    []
-                )
-            elif elem.tag == 'tag':
-                obj.tags.append(
-                    model.Tag(
-                        elem.attrib['k'],
-                        elem.attrib['v']
-                    )
-                )
-            elif elem.tag == 'nd':
-                obj.nds.append(int(elem.attrib['ref']))
-            elif elem.tag == 'relation':
-                obj = model.Relation(
-                    int(elem.attrib['id']),
-                    int(elem.attrib['version']),
-                    int(elem.attrib['changeset']),
-                    elem.attrib.get('user'),
-                    maybeInt(elem.attrib.get('uid')),
-                    maybeBool(elem.attrib.get('visible')),
-                    isoToDatetime(elem.attrib.get('timestamp')) if parse_timestamps else elem.attrib.get('timestamp'),
-                    [],
-                    []
-                )
-            elif elem.tag == 'member':
-                obj.members.append(
-                    model.Member(
-                        elem.attrib['type'],
-                        int(elem.attrib['ref']),
-                        elem.attrib['role']
-                    )
-                )
-            elif elem.tag in ('create', 'modify', 'delete'):
-                action = elem.tag
-        elif event == 'end':
-            if elem.tag == 'node':
-                yield (action, obj)
-                obj = None
-            elif elem.tag == 'way':
-                yield (action, obj)
-                obj = None
-            elif elem.tag == 'relation':
-                yield (action, obj)
-                obj = None
-            elif elem.tag in ('create', 'modify', 'delete'):
-                action = None
+def iter_osm_change_file(f, parse_timestamps=True, skip=(), element_filter=None, interner=None, compact=False):
+    """Parse a file-like containing OSM change XML and yield one (action, primitive)
+    tuple at a time to the caller. See iter_osm_file for the skip,
+    element_filter, interner and compact options."""
+
+    for action, obj in _iter_parse(f, _OSMTarget(parse_timestamps, skip, element_filter, None, interner, compact)):
+        yield (action, obj)
 
-        elem.clear()
-        while elem.getprevious() is not None:
-            del elem.getparent()[0]
+def _sequence_url(base_url, sequence, suffix):
+    """Return the URL of a replication file, e.g. .../000/123/456.osc.gz."""
+    sqnStr = str(sequence).zfill(9)
+    return '%s/%s/%s/%s%s' % (base_url, sqnStr[0:3], sqnStr[3:6], sqnStr[6:9], suffix)
+
+def _fetch_state(url, sep='=', cache=None):
+    """Fetch a replication state file, returning its text and parsed contents."""
+    f = _open_url(url, cache)
+    try:
+        text = f.read().decode('utf-8')
+    finally:
+        f.close()
+    return text, readState(text.splitlines(), sep)
+
+def _wait_for_state(url, cache=None):
+    """Fetch a replication state file, waiting with a growing delay for it
+    to be published if it doesn't exist yet. Returns its text, its parsed
+    contents and how many seconds were spent waiting."""
+    delay = 1.0
+    waited = 0.0
+    while True:
+        try:
+            state_text, state = _fetch_state(url, cache=cache)
+            return state_text, state, waited
+        except httpclient.HTTPError as e:
+            if e.code != 404:
+                raise
+            time.sleep(delay)
+            waited += delay
+            delay = min(delay * 2, 13)
 
-def iter_osm_stream(start_sqn=None, base_url='https://planet.openstreetmap.org/replication/minute', expected_interval=60, parse_timestamps=True, state_dir=None):
+def _stateTimestamp(state):
+    return datetime.datetime.strptime(state['timestamp'], "%Y-%m-%dT%H:%M:%SZ")
+
+def _fetch_diff(args):
+    """Fetch the state file and parse the whole diff for one sequence number.
+    Run in a thread pool while iter_osm_stream is catching up."""
+    base_url, sequence, parse_timestamps, cache = args
+    state_text, state = _fetch_state(_sequence_url(base_url, sequence, '.state.txt'), cache=cache)
+    # Nothing reaches the caller until the whole diff is parsed, so parsing it
+    # as a single item lets _iter_download retry a failure at any point.
+    diff = _iter_download(_sequence_url(base_url, sequence, '.osc.gz'), cache, _parse_whole_change_file, (parse_timestamps,))
+    try:
+        changes = next(diff)
+    finally:
+        diff.close()
+    return state_text, state, changes
+
+def _parse_whole_change_file(content, parse_timestamps):
+    yield list(iter_osm_change_file(content, parse_timestamps))
+
+def iter_osm_stream(start_sqn=None, base_url='https://planet.openstreetmap.org/replication/minute', expected_interval=60, parse_timestamps=True, state_dir=None, prefetch=0, start_time=None, cache=None):
     """Start processing an OSM diff stream and yield one changeset at a time to
-    the caller."""
+    the caller. Pass start_time (a UTC datetime) instead of start_sqn to start
+    from the first diff after that time; see find_sequence_for_timestamp.
+
+    With prefetch greater than 0, whenever the stream is behind the latest
+    published diff the next prefetch state files and diffs are downloaded and
+    parsed concurrently in threads while earlier ones are being consumed.
+    Changes and Finished markers still come out strictly in sequence order.
+    Once caught up it goes back to polling for one diff at a time.
+
+    cache is an optional pyosm.cache.DiskCache that state files and diffs are
+    read from and saved to. An offline cache needs a starting sequence, skips
+    prefetching, and the stream ends at the first sequence it doesn't have."""
+
+    offline = cache is not None and cache.offline
 
     # If the user specifies a state_dir, read the state from the statefile there
     if state_dir:
@@ -224,175 +712,491 @@ def iter_osm_stream(start_sqn=None, base_url='https://planet.openstreetmap.org/r
                 state = readState(f)
                 start_sqn = state['sequenceNumber']
 
-    # If no start_sqn, assume to start from the most recent diff
-    if not start_sqn:
-        u = urllib2.urlopen('%s/state.txt' % base_url)
-        state = readState(u)
-    else:
-        sqnStr = str(start_sqn).zfill(9)
-        u = urllib2.urlopen('%s/%s/%s/%s.state.txt' % (base_url, sqnStr[0:3], sqnStr[3:6], sqnStr[6:9]))
-        state = readState(u)
+    if not start_sqn and start_time is not None:
+        start_sqn = find_sequence_for_timestamp(base_url, start_time)
+
+    if not start_sqn and offline:
+        raise Exception('Replaying from an offline cache needs a start_sqn')
 
     interval_fudge = 0.0
+    pool = None
+    # Whether the stream might be behind the latest published diff. That is
+    # only worth asking the server about at the start and when the next
+    # state file was already there, not for every diff in real time.
+    maybe_behind = True
 
-    while True:
-        sqnStr = state['sequenceNumber'].zfill(9)
-        url = '%s/%s/%s/%s.osc.gz' % (base_url, sqnStr[0:3], sqnStr[3:6], sqnStr[6:9])
-        content = urllib2.urlopen(url)
-        content = StringIO.StringIO(content.read())
-        gzipper = gzip.GzipFile(fileobj=content)
-
-        for a in iter_osm_change_file(gzipper, parse_timestamps):
-            yield a
-
-        # After parsing the OSC, check to see how much time is remaining
-        stateTs = datetime.datetime.strptime(state['timestamp'], "%Y-%m-%dT%H:%M:%SZ")
-        yield (None, model.Finished(state['sequenceNumber'], stateTs))
-
-        nextTs = stateTs + datetime.timedelta(seconds=expected_interval + interval_fudge)
-        if datetime.datetime.utcnow() < nextTs:
-            timeToSleep = (nextTs - datetime.datetime.utcnow()).total_seconds()
+    try:
+        # If no start_sqn, assume to start from the most recent diff. A
+        # start_sqn (or start_time) may be for the next diff to be published.
+        if not start_sqn:
+            state_text, state = _fetch_state('%s/state.txt' % base_url)
         else:
-            timeToSleep = 0.0
-        time.sleep(timeToSleep)
+            state_text, state, waited = _wait_for_state(_sequence_url(base_url, start_sqn, '.state.txt'), cache)
 
-        # Then try to fetch the next state file
-        sqnStr = str(int(state['sequenceNumber']) + 1).zfill(9)
-        url = '%s/%s/%s/%s.state.txt' % (base_url, sqnStr[0:3], sqnStr[3:6], sqnStr[6:9])
-        delay = 1.0
         while True:
+            sequence = int(state['sequenceNumber'])
+
+            latest = None
+            if prefetch and not offline and maybe_behind:
+                latest = int(_fetch_state('%s/state.txt' % base_url)[1]['sequenceNumber'])
+
+            changes = _iter_download(_sequence_url(base_url, sequence, '.osc.gz'), cache, iter_osm_change_file, (parse_timestamps,))
             try:
-                u = urllib2.urlopen(url)
-                interval_fudge -= (interval_fudge / 2.0)
-                break
-            except urllib2.HTTPError as e:
-                if e.code == 404:
-                    time.sleep(delay)
-                    delay = min(delay * 2, 13)
-                    interval_fudge += delay
+                for a in changes:
+                    yield a
+            finally:
+                changes.close()
 
-        if state_dir:
-            with open('%s/state.txt' % state_dir, 'w') as f:
-                f.write(u.read())
-            with open('%s/state.txt' % state_dir, 'r') as f:
-                state = readState(f)
+            # After parsing the OSC, check to see how much time is remaining
+            stateTs = _stateTimestamp(state)
+            yield (None, model.Finished(state['sequenceNumber'], stateTs))
+
+            if latest is not None and latest > sequence:
+                # Catching up, so fetch and parse several diffs at once
+                if pool is None:
+                    pool = ThreadPool(prefetch)
+                tasks = ((base_url, s, parse_timestamps, cache) for s in range(sequence + 1, latest + 1))
+                for state_text, state, changes in imap_bounded(pool, _fetch_diff, tasks, prefetch):
+                    if state_dir:
+                        with open('%s/state.txt' % state_dir, 'w') as f:
+                            f.write(state_text)
+
+                    for a in changes:
+                        yield a
+
+                    stateTs = _stateTimestamp(state)
+                    yield (None, model.Finished(state['sequenceNumber'], stateTs))
+
+            nextTs = stateTs + datetime.timedelta(seconds=expected_interval + interval_fudge)
+            if datetime.datetime.utcnow() < nextTs:
+                timeToSleep = (nextTs - datetime.datetime.utcnow()).total_seconds()
+            else:
+                timeToSleep = 0.0
+            time.sleep(timeToSleep)
+
+            # Then try to fetch the next state file
+            url = _sequence_url(base_url, int(state['sequenceNumber']) + 1, '.state.txt')
+            state_text, state, waited = _wait_for_state(url, cache)
+            interval_fudge += waited
+            interval_fudge -= (interval_fudge / 2.0)
+            maybe_behind = timeToSleep <= 0 and not waited
+
+            if state_dir:
+                with open('%s/state.txt' % state_dir, 'w') as f:
+                    f.write(state_text)
+    except CacheMiss:
+        return
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+## Finding sequence numbers by time
+
+# Probed (sequence, time) pairs are kept in this file, one "base_url sequence
+# epoch" line each, since published states never change. A "-" epoch records
+# a sequence that doesn't exist.
+DEFAULT_SEQUENCE_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'pyosm', 'sequences.txt')
+
+class _SequenceCache(object):
+    """Probed sequence times for each feed, loaded from and appended to a file
+    (or only kept in memory if path is None)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.feeds = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    base_url, sequence, epoch = line.split()
+                    self.feeds.setdefault(base_url, {})[int(sequence)] = None if epoch == '-' else int(epoch)
+
+    def probes(self, base_url):
+        return self.feeds.setdefault(base_url, {})
+
+    def add(self, base_url, sequence, epoch):
+        self.probes(base_url)[sequence] = epoch
+        if self.path is not None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            with open(self.path, 'a') as f:
+                f.write('%s %d %s\n' % (base_url, sequence, '-' if epoch is None else epoch))
+
+_sequence_caches = {}
+
+def _sequence_cache(path):
+    cache = _sequence_caches.get(path)
+    if cache is None:
+        cache = _sequence_caches[path] = _SequenceCache(path)
+    return cache
+
+def _toEpoch(timestamp):
+    if isinstance(timestamp, datetime.datetime):
+        return calendar.timegm(timestamp.utctimetuple())
+    return int(timestamp)
+
+def _latest_sequence(base_url):
+    """Return (is_changeset_feed, latest sequence) for a replication feed. Diff
+    feeds publish state.txt and the changeset feed publishes state.yaml."""
+    try:
+        return False, int(_fetch_state('%s/state.txt' % base_url)[1]['sequenceNumber'])
+    except httpclient.HTTPError as e:
+        if e.code != 404:
+            raise
+    return True, int(_fetch_state('%s/state.yaml' % base_url, ': ')[1]['sequence'])
+
+def _probe_sequence(base_url, sequence, changesets):
+    """Return the epoch time of one sequence of a feed, or None if it doesn't
+    exist. The changeset feed has no per-sequence state files, so the time its
+    diff was last modified is used instead."""
+    try:
+        if changesets:
+            response = httpclient.head(_sequence_url(base_url, sequence, '.osm.gz'))
+            try:
+                modified = response.getheader('Last-Modified')
+            finally:
+                response.close()
+            return email.utils.mktime_tz(email.utils.parsedate_tz(modified))
+        return _toEpoch(_stateTimestamp(_fetch_state(_sequence_url(base_url, sequence, '.state.txt'))[1]))
+    except httpclient.HTTPError as e:
+        if e.code == 404:
+            return None
+        raise
+
+def _find_state_before(base_url, timestamp, cache_file=DEFAULT_SEQUENCE_CACHE):
+    """Search a replication feed for the last sequence whose state is at or
+    before timestamp. Returns (sequence, epoch); epoch is None if every
+    available state is newer, in which case sequence + 1 is the oldest one.
+
+    Probes interpolate between the closest known states on either side, which
+    lands close to the answer for feeds published at a steady rate, and fall
+    back to bisecting when that isn't narrowing things down quickly."""
+
+    target = _toEpoch(timestamp)
+    cache = _sequence_cache(cache_file)
+    probes = cache.probes(base_url)
+
+    def probe(sequence):
+        if sequence not in probes:
+            cache.add(base_url, sequence, _probe_sequence(base_url, sequence, changesets))
+        return probes[sequence]
+
+    # Start from the closest cached states on either side of the target. A
+    # missing state counts as older than everything.
+    lo, lo_ts = -1, None
+    hi, hi_ts = None, None
+    for sequence, epoch in probes.items():
+        if epoch is None or epoch <= target:
+            if sequence > lo:
+                lo, lo_ts = sequence, epoch
+        elif hi is None or sequence < hi:
+            hi, hi_ts = sequence, epoch
+
+    if hi is None or hi - lo > 1:
+        changesets, latest = _latest_sequence(base_url)
+        if hi is None:
+            hi, hi_ts = latest, probe(latest)
+            if hi_ts is None or hi_ts <= target:
+                return hi, hi_ts
+
+    # Without a lower bound, guess one from the rate the feed is published at
+    # and step further back until the target is bracketed.
+    if lo < 0 and hi - lo > 1:
+        before = probe(hi - 1) if hi > 0 else None
+        interval = max(hi_ts - before, 1) if before is not None else 60
+        step = max(1, (hi_ts - target) // interval)
+        while lo < 0 and hi - lo > 1:
+            guess = max(hi - step, 0)
+            epoch = probe(guess)
+            if epoch is None or epoch <= target:
+                lo, lo_ts = guess, epoch
+            else:
+                hi, hi_ts = guess, epoch
+                step *= 2
+
+    interpolate = True
+    while hi - lo > 1:
+        if interpolate and lo_ts is not None:
+            guess = lo + int((target - lo_ts) * (hi - lo) // max(hi_ts - lo_ts, 1))
+            guess = min(max(guess, lo + 1), hi - 1)
+        else:
+            guess = (lo + hi) // 2
+
+        width = hi - lo
+        epoch = probe(guess)
+        if epoch is None or epoch <= target:
+            lo, lo_ts = guess, epoch
         else:
-            state = readState(u)
+            hi, hi_ts = guess, epoch
+        # Bisect next time if interpolating didn't halve the range
+        interpolate = (hi - lo) * 2 <= width
+
+    return lo, lo_ts
+
+def find_sequence_for_timestamp(base_url, timestamp, cache_file=DEFAULT_SEQUENCE_CACHE):
+    """Return the sequence number of the first diff in a replication feed (a
+    minutely, hourly or daily diff feed or the changeset feed) with changes
+    after timestamp, which is a UTC datetime or seconds since the epoch.
+    Starting a stream from that sequence misses nothing after timestamp.
+
+    Probed state times are kept in cache_file so later lookups make few or no
+    requests; pass None to only cache them for this process."""
+
+    return _find_state_before(base_url, timestamp, cache_file)[0] + 1
+
+# The replication feeds published under one replication root, coarsest
+# first, with the number of seconds each diff covers.
+REPLICATION_FEEDS = (
+    ('day', 86400),
+    ('hour', 3600),
+    ('minute', 60),
+)
+
+def _pick_feed(behind):
+    """Return the index in REPLICATION_FEEDS of the coarsest feed worth using
+    when the consumer is behind by the given number of seconds. Waiting for
+    two periods makes sure the next diff of that feed has been published."""
+    for level, (name, period) in enumerate(REPLICATION_FEEDS):
+        if behind >= 2 * period:
+            return level
+    return len(REPLICATION_FEEDS) - 1
+
+def _switch_feed(replication_url, level, timestamp):
+    """Decide whether to move to another feed after consuming everything up
+    to timestamp on feed number level. Returns (level, next sequence) for the
+    new feed or None to stay put."""
+
+    behind = (datetime.datetime.utcnow() - timestamp).total_seconds()
+    target = _pick_feed(behind)
+
+    if target > level:
+        # Stepping down to a finer feed. Its states normally line up with the
+        # coarser ones; if they don't, start from the one just before so
+        # nothing is missed.
+        sequence, epoch = _find_state_before('%s/%s' % (replication_url, REPLICATION_FEEDS[target][0]), timestamp)
+        return target, sequence + 1
+    elif target < level:
+        # Only step up to a coarser feed from a state it shares, so that no
+        # changes are skipped or repeated.
+        epoch = calendar.timegm(timestamp.utctimetuple())
+        for coarser in range(target, level):
+            name, period = REPLICATION_FEEDS[coarser]
+            if epoch % period:
+                continue
+            sequence, found = _find_state_before('%s/%s' % (replication_url, name), timestamp)
+            if found == epoch:
+                return coarser, sequence + 1
+
+    return None
+
+def iter_osm_stream_auto(start_sqn=None, replication_url='https://planet.openstreetmap.org/replication', parse_timestamps=True, state_dir=None, prefetch=0, start_time=None):
+    """Like iter_osm_stream, but switches between the day, hour and minute
+    feeds under replication_url so that a consumer that is far behind catches
+    up with a few large diffs rather than thousands of minute diffs, and then
+    steps down to minute diffs once it is close to real time.
+
+    start_sqn is a minute sequence number; without one (or a start_time) the
+    stream starts from the latest minute diff. With start_time the first diff
+    comes from a feed suited to how long ago that is, so it may also hold some
+    changes from before start_time. Feeds are lined up by their state timestamps. The
+    sequence in each Finished marker belongs to whichever feed that diff came
+    from, so use its timestamp to track progress across feeds.
+
+    state_dir keeps a state.txt with the feed and the next sequence number to
+    fetch from it, which is not interchangeable with iter_osm_stream's.
+    prefetch is passed on to iter_osm_stream."""
+
+    level = len(REPLICATION_FEEDS) - 1
+    sequence = start_sqn
+    if not sequence and start_time is not None:
+        # Start on whichever feed suits how far back start_time is
+        level = _pick_feed((datetime.datetime.utcnow() - start_time).total_seconds())
+        sequence = find_sequence_for_timestamp('%s/%s' % (replication_url, REPLICATION_FEEDS[level][0]), start_time)
+
+    if state_dir:
+        if not os.path.exists(state_dir):
+            raise Exception('Specified state_dir "%s" doesn\'t exist.' % state_dir)
+
+        if os.path.exists('%s/state.txt' % state_dir):
+            with open('%s/state.txt' % state_dir) as f:
+                state = readState(f)
+            level = [name for name, period in REPLICATION_FEEDS].index(state['feed'])
+            sequence = state['sequenceNumber']
+
+    while True:
+        name, period = REPLICATION_FEEDS[level]
+        stream = iter_osm_stream(sequence, '%s/%s' % (replication_url, name), period, parse_timestamps, prefetch=prefetch)
+
+        switch = None
+        try:
+            for action, obj in stream:
+                yield (action, obj)
+
+                if type(obj) is not model.Finished:
+                    continue
+
+                sequence = int(obj.sequence) + 1
+                switch = _switch_feed(replication_url, level, obj.timestamp)
+                if switch is not None:
+                    level, sequence = switch
+
+                if state_dir:
+                    with open('%s/state.txt' % state_dir, 'w') as f:
+                        f.write('feed=%s\nsequenceNumber=%d\n' % (REPLICATION_FEEDS[level][0], sequence))
+
+                if switch is not None:
+                    break
+        finally:
+            stream.close()
 
-def iter_osm_file(f, parse_timestamps=True):
+class _WaysOf(object):
+    """Restricts a filter to ways, for collecting the nodes that kept ways use."""
+
+    def __init__(self, element_filter):
+        self.element_filter = element_filter
+        self.types = frozenset(['way'])
+        self.needs_tags = element_filter.needs_tags
+
+    def accepts(self, kind, tags):
+        return kind == 'way' and self.element_filter.accepts(kind, tags)
+
+def _collect_way_nodes(f, element_filter):
+    """Return the set of node ids referenced by the ways element_filter accepts."""
+    node_ids = set()
+    target = _OSMTarget(False, ('metadata', 'members'), _WaysOf(element_filter))
+    for action, way in _iter_parse(f, target):
+        node_ids.update(way.nds)
+    return node_ids
+
+def iter_osm_file(f, parse_timestamps=True, skip=(), element_filter=None, keep_way_nodes=False, interner=None, compact=False):
     """Parse a file-like containing OSM XML and yield one OSM primitive at a time
-    to the caller."""
-
-    obj = None
-    for event, elem in etree.iterparse(f, events=('start', 'end')):
-        if event == 'start':
-            if elem.tag == 'node':
-                obj = model.Node(
-                    int(elem.attrib['id']),
-                    maybeInt(elem.get('version')),
-                    maybeInt(elem.get('changeset')),
-                    elem.attrib.get('user'),
-                    maybeInt(elem.attrib.get('uid')),
-                    maybeBool(elem.attrib.get('visible')),
-                    isoToDatetime(elem.attrib.get('timestamp')) if parse_timestamps else elem.attrib.get('timestamp'),
-                    maybeFloat(elem.get('lat')),
-                    maybeFloat(elem.get('lon')),
-                    []
-                )
-            elif elem.tag == 'way':
-                obj = model.Way(
-                    int(elem.attrib['id']),
-                    maybeInt(elem.get('version')),
-                    maybeInt(elem.get('changeset')),
-                    elem.attrib.get('user'),
-                    maybeInt(elem.attrib.get('uid')),
-                    maybeBool(elem.attrib.get('visible')),
-                    isoToDatetime(elem.attrib.get('timestamp')) if parse_timestamps else elem.attrib.get('timestamp'),
-                    [],
-                    []
-                )
-            elif elem.tag == 'tag':
-                obj.tags.append(
-                    model.Tag(
-                        elem.attrib['k'],
-                        elem.attrib['v']
-                    )
-                )
-            elif elem.tag == 'nd':
-                obj.nds.append(int(elem.attrib['ref']))
-            elif elem.tag == 'relation':
-                obj = model.Relation(
-                    int(elem.attrib['id']),
-                    maybeInt(elem.get('version')),
-                    maybeInt(elem.get('changeset')),
-                    elem.attrib.get('user'),
-                    maybeInt(elem.attrib.get('uid')),
-                    maybeBool(elem.attrib.get('visible')),
-                    isoToDatetime(elem.attrib.get('timestamp')) if parse_timestamps else elem.attrib.get('timestamp'),
-                    [],
-                    []
-                )
-            elif elem.tag == 'member':
-                obj.members.append(
-                    model.Member(
-                        elem.attrib['type'],
-                        int(elem.attrib['ref']),
-                        elem.attrib['role']
-                    )
-                )
-            elif elem.tag == 'changeset':
-                obj = model.Changeset(
-                    int(elem.attrib['id']),
-                    isoToDatetime(elem.attrib.get('created_at')) if parse_timestamps else elem.attrib.get('created_at'),
-                    isoToDatetime(elem.attrib.get('closed_at')) if parse_timestamps else elem.attrib.get('closed_at'),
-                    maybeBool(elem.attrib['open']),
-                    maybeFloat(elem.get('min_lat')),
-                    maybeFloat(elem.get('max_lat')),
-                    maybeFloat(elem.get('min_lon')),
-                    maybeFloat(elem.get('max_lon')),
-                    elem.attrib.get('user'),
-                    maybeInt(elem.attrib.get('uid')),
-                    []
-                )
-        elif event == 'end':
-            if elem.tag == 'node':
-                yield obj
-                obj = None
-            elif elem.tag == 'way':
-                yield obj
-                obj = None
-            elif elem.tag == 'relation':
-                yield obj
-                obj = None
-            elif elem.tag == 'changeset':
-                yield obj
-                obj = None
+    to the caller.
+
+    Timestamps are parsed to datetimes by default. Pass parse_timestamps='epoch'
+    to get integer seconds since the Unix epoch instead, or False to get the raw
+    strings.
+
+    skip is a collection of field groups from SKIP_FIELDS ('tags', 'metadata',
+    'nds', 'members') that should not be built. Those fields are None on the
+    returned objects. 'metadata' covers version, changeset, user, uid, visible
+    and timestamp (and created_at, closed_at and open for changesets).
+
+    element_filter is a filter from pyosm.filters that is checked inside the
+    parser; elements it rejects are dropped before any model object is built.
+    With keep_way_nodes=True the nodes referenced by accepted ways are kept too,
+    whatever their tags, so way geometries can still be built. That needs an
+    extra pass over the input, so f must be a filename or a seekable file.
+
+    interner is an optional pyosm.interning.StringInterner. Tag keys, tag
+    values and user names are routed through it so that repeated strings
+    share one object, which matters when the results are kept in memory.
+
+    With compact=True nodes, ways and relations are returned as the
+    CompactNode, CompactWay and CompactRelation classes from pyosm.model, which
+    have the same attribute names but take a fraction of the memory."""
 
-        elem.clear()
-        while elem.getprevious() is not None:
-            del elem.getparent()[0]
+    keep_nodes = None
+    if element_filter is not None and keep_way_nodes:
+        if hasattr(f, 'read'):
+            position = f.tell()
+            keep_nodes = _collect_way_nodes(f, element_filter)
+            f.seek(position)
+        else:
+            keep_nodes = _collect_way_nodes(f, element_filter)
+
+    for action, obj in _iter_parse(f, _OSMTarget(parse_timestamps, skip, element_filter, keep_nodes, interner, compact)):
+        yield obj
+
+# Matches the start of a top-level element (or the end of the document) in an
+# OSM XML file. Attribute values can't contain a literal '<', so any match is a
+# real element boundary.
+_ELEMENT_BOUNDARY = re.compile(br'<(?:node|way|relation|changeset)[\s/>]|</osm>')
+
+def _find_element_boundary(fp, offset, block_size=65536):
+    """Return the file offset of the first top-level element that starts at or
+    after offset, or the end of the file if there isn't one."""
+    fp.seek(offset)
+    base = offset
+    tail = b''
+    while True:
+        block = fp.read(block_size)
+        if not block:
+            return base + len(tail)
+
+        buf = tail + block
+        match = _ELEMENT_BOUNDARY.search(buf)
+        if match:
+            return base + match.start()
+
+        # Keep enough of the end of the buffer to match a tag split across reads
+        keep = min(len(buf), 11)
+        tail = buf[-keep:]
+        base += len(buf) - keep
+
+def _parse_osm_file_range(args):
+    filename, start, end, parse_timestamps, skip, element_filter, compact = args
+
+    with open(filename, 'rb') as fp:
+        begin = _find_element_boundary(fp, start)
+        finish = _find_element_boundary(fp, end)
+        if begin >= finish:
+            return []
+        fp.seek(begin)
+        data = fp.read(finish - begin)
+
+    # The last range runs to the end of the file, past the closing </osm>
+    data = data.split(b'</osm>', 1)[0]
+
+    return list(iter_osm_file(io.BytesIO(b'<osm>' + data + b'</osm>'), parse_timestamps, skip, element_filter, compact=compact))
+
+def iter_osm_file_parallel(filename, parse_timestamps=True, processes=None, chunk_size=64 * 1024 * 1024, ordered=True, max_in_flight=None, skip=(), element_filter=None, compact=False):
+    """Parse an OSM XML file using a pool of worker processes and yield one OSM
+    primitive at a time to the caller.
+
+    The file is split into byte ranges of roughly chunk_size bytes, each of
+    which is resynchronized to the next top-level element and parsed in a
+    worker. With ordered=False primitives are yielded a chunk at a time in
+    whatever order the chunks finish. parse_timestamps, skip, element_filter and
+    compact behave as they do for iter_osm_file."""
+
+    size = os.path.getsize(filename)
+    processes = processes or multiprocessing.cpu_count()
+    tasks = ((filename, start, min(start + chunk_size, size), parse_timestamps, skip, element_filter, compact) for start in range(0, size, chunk_size))
 
-def parse_osm_file(f, parse_timestamps=True):
+    pool = multiprocessing.Pool(processes)
+    try:
+        for objects in imap_bounded(pool, _parse_osm_file_range, tasks, max_in_flight or processes * 2, ordered):
+            for obj in objects:
+                yield obj
+    finally:
+        pool.terminate()
+
+def parse_osm_file(f, parse_timestamps=True, interner=None, compact=False):
     """Parse a file-like containing OSM XML into memory and return an object with
-    the nodes, ways, and relations it contains. """
+    the nodes, ways, and relations it contains. Passing a StringInterner from
+    pyosm.interning shares repeated strings between the parsed objects, and
+    compact=True stores them using the compact model classes. """
 
     nodes = []
     ways = []
     relations = []
 
-    for p in iter_osm_file(f, parse_timestamps):
+    for p in iter_osm_file(f, parse_timestamps, interner=interner, compact=compact):
 
-        if type(p) == model.Node:
+        if type(p) in (model.Node, model.CompactNode):
             nodes.append(p)
-        elif type(p) == model.Way:
+        elif type(p) in (model.Way, model.CompactWay):
             ways.append(p)
-        elif type(p) == model.Relation:
+        elif type(p) in (model.Relation, model.CompactRelation):
             relations.append(p)
 
     return (nodes, ways, relations)
 
 def get_note(note_id, parse_timestamps=True):
-    u = urllib2.urlopen('https://www.openstreetmap.org/api/0.6/notes/%d' % note_id)
+    return _parse_note(httpclient.get('https://www.openstreetmap.org/api/0.6/notes/%d' % note_id), parse_timestamps)
+
+def _parse_note(u, parse_timestamps=True):
+    """Build a Note from a file-like of a note's API XML."""
     tree = etree.parse(u)
     note_elem = tree.xpath('/osm/note')[0]
 
@@ -423,29 +1227,36 @@ def get_note(note_id, parse_timestamps=True):
         comments=[parse_comment(c) for c in note_elem.xpath('comments/comment')]
     )
 
+def _parse_notes_feed(u):
+    """Return (action, guid) pairs for the items in the notes RSS feed, newest first."""
+    tree = etree.parse(u)
+
+    items = []
+    for note_item in tree.xpath('/rss/channel/item'):
+        title = note_item.xpath('title')[0].text
+
+        if title.startswith('new note ('):
+            action = 'create'
+        elif title.startswith('new comment ('):
+            action = 'comment'
+        elif title.startswith('closed note ('):
+            action = 'close'
+
+        # Note that (at least for now) the link and guid are the same in the feed.
+        guid = note_item.xpath('link')[0].text
+        items.append((action, guid))
+
+    return items
+
 def iter_osm_notes(feed_limit=25, interval=60, parse_timestamps=True):
     """ Parses the global OSM Notes feed and yields as much Note information as possible. """
 
     last_seen_guid = None
     while True:
-        u = urllib2.urlopen('https://www.openstreetmap.org/api/0.6/notes/feed?limit=%d' % feed_limit)
-
-        tree = etree.parse(u)
+        u = httpclient.get('https://www.openstreetmap.org/api/0.6/notes/feed', params={'limit': feed_limit})
 
         new_notes = []
-        for note_item in tree.xpath('/rss/channel/item'):
-            title = note_item.xpath('title')[0].text
-
-            if title.startswith('new note ('):
-                action = 'create'
-            elif title.startswith('new comment ('):
-                action = 'comment'
-            elif title.startswith('closed note ('):
-                action = 'close'
-
-            # Note that (at least for now) the link and guid are the same in the feed.
-            guid = note_item.xpath('link')[0].text
-
+        for action, guid in _parse_notes_feed(u):
             if last_seen_guid == guid:
                 break
             elif last_seen_guid == None:
@@ -0,0 +1,513 @@
+import pyosm.model as model
+import datetime
+import multiprocessing
+import struct
+import time
+import zlib
+from pyosm.workers import imap_bounded
+
+# The OSM PBF format is a sequence of (BlobHeader, Blob) pairs. Each Blob holds
+# either an OSMHeader block or an OSMData (PrimitiveBlock) block. The protobuf
+# messages are simple enough that decoding them by hand avoids a dependency on
+# generated protobuf code. Field numbers follow osmformat.proto/fileformat.proto.
+
+SUPPORTED_FEATURES = set(['OsmSchema-V0.6', 'DenseNodes', 'HistoricalInformation'])
+MEMBER_TYPES = ('node', 'way', 'relation')
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# Edits cluster in time, so like the XML parser's timestamp caches these
+# memoize conversions per value and are cleared when they fill up.
+_TIMESTAMP_CACHE_SIZE = 8192
+_datetime_cache = {}
+_iso_cache = {}
+_date_cache = {}
+
+def _secondsToDatetime(seconds):
+    dt = _datetime_cache.get(seconds)
+    if dt is None:
+        dt = _EPOCH + datetime.timedelta(seconds=seconds)
+        if len(_datetime_cache) >= _TIMESTAMP_CACHE_SIZE:
+            _datetime_cache.clear()
+        _datetime_cache[seconds] = dt
+    return dt
+
+def _secondsToIso(seconds):
+    s = _iso_cache.get(seconds)
+    if s is None:
+        days, rest = divmod(seconds, 86400)
+        date = _date_cache.get(days)
+        if date is None:
+            date = time.strftime('%Y-%m-%dT', time.gmtime(days * 86400))
+            if len(_date_cache) >= _TIMESTAMP_CACHE_SIZE:
+                _date_cache.clear()
+            _date_cache[days] = date
+        s = '%s%02d:%02d:%02dZ' % (date, rest // 3600, rest // 60 % 60, rest % 60)
+        if len(_iso_cache) >= _TIMESTAMP_CACHE_SIZE:
+            _iso_cache.clear()
+        _iso_cache[seconds] = s
+    return s
+
+def _noConversion(seconds):
+    return seconds
+
+def _secondsConverter(parse_timestamps):
+    """Return the function that converts seconds since the epoch for the
+    given parse_timestamps option, as parsing._timestampConverter does for
+    XML timestamp strings."""
+    if parse_timestamps == 'epoch':
+        return _noConversion
+    elif parse_timestamps:
+        return _secondsToDatetime
+    return _secondsToIso
+
+def _varint(buf, pos):
+    """Decode a base-128 varint from buf at pos, returning (value, new_pos)."""
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+def _signed(v):
+    """Reinterpret a varint as a two's-complement int64."""
+    return v - (1 << 64) if v >= (1 << 63) else v
+
+def _zigzag(v):
+    return (v >> 1) ^ -(v & 1)
+
+def _iter_fields(buf):
+    """Yield (field_number, value) for each field in a protobuf message.
+    Varints are returned as ints and length-delimited fields as bytearrays."""
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        wire_type = key & 0x07
+        if wire_type == 0:
+            value, pos = _varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = _varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = struct.unpack('<q', bytes(buf[pos:pos + 8]))[0]
+            pos += 8
+        elif wire_type == 5:
+            value = struct.unpack('<i', bytes(buf[pos:pos + 4]))[0]
+            pos += 4
+        else:
+            raise Exception('Unsupported protobuf wire type %d' % wire_type)
+        yield key >> 3, value
+
+def _packed(buf):
+    """Decode a packed repeated varint field into a list of unsigned ints."""
+    values = []
+    append = values.append
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        b = buf[pos]
+        pos += 1
+        if b < 0x80:
+            append(b)
+            continue
+        result = b & 0x7f
+        shift = 7
+        while True:
+            b = buf[pos]
+            pos += 1
+            result |= (b & 0x7f) << shift
+            if not b & 0x80:
+                break
+            shift += 7
+        append(result)
+    return values
+
+def _packed_delta(buf):
+    """Decode a packed, zigzag-encoded, delta-coded field. This is _packed
+    with the zigzag and delta decoding folded in, since it is used for ids,
+    coordinates and timestamps of every dense node."""
+    values = []
+    append = values.append
+    last = 0
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        b = buf[pos]
+        pos += 1
+        if b < 0x80:
+            last += (b >> 1) ^ -(b & 1)
+            append(last)
+            continue
+        result = b & 0x7f
+        shift = 7
+        while True:
+            b = buf[pos]
+            pos += 1
+            result |= (b & 0x7f) << shift
+            if not b & 0x80:
+                break
+            shift += 7
+        last += (result >> 1) ^ -(result & 1)
+        append(last)
+    return values
+
+def _read_blobs(f):
+    """Yield (blob_type, blob_bytes) for each raw, still-compressed blob in f."""
+    while True:
+        header_len = f.read(4)
+        if not header_len:
+            return
+        if len(header_len) < 4:
+            raise Exception('Truncated PBF blob header length')
+        (header_len,) = struct.unpack('>I', header_len)
+
+        blob_type = None
+        data_size = None
+        for field, value in _iter_fields(bytearray(f.read(header_len))):
+            if field == 1:
+                blob_type = bytes(value).decode('utf-8')
+            elif field == 3:
+                data_size = value
+
+        data = f.read(data_size)
+        if len(data) < data_size:
+            raise Exception('Truncated PBF blob of type %s' % blob_type)
+
+        yield blob_type, data
+
+def _decompress_blob(data):
+    """Return the uncompressed payload of a Blob message."""
+    for field, value in _iter_fields(bytearray(data)):
+        if field == 1:
+            return value
+        elif field == 3:
+            return bytearray(zlib.decompress(bytes(value)))
+        elif field == 4:
+            import lzma
+            return bytearray(lzma.decompress(bytes(value)))
+        elif field in (5, 6, 7):
+            raise Exception('Unsupported PBF blob compression (field %d)' % field)
+    raise Exception('PBF blob contains no data')
+
+def _check_header(buf):
+    for field, value in _iter_fields(buf):
+        if field == 4:
+            feature = bytes(value).decode('utf-8')
+            if feature not in SUPPORTED_FEATURES:
+                raise Exception('PBF file requires unsupported feature "%s"' % feature)
+
+class _Block(object):
+    """Block-level decoding state: the string table and coordinate/time scaling."""
+
+    def __init__(self, strings, granularity, date_granularity, lat_offset, lon_offset, parse_timestamps):
+        self.strings = strings
+        self.granularity = granularity
+        self.date_granularity = date_granularity
+        self.lat_offset = lat_offset
+        self.lon_offset = lon_offset
+        self.convert_seconds = _secondsConverter(parse_timestamps)
+
+    def lat(self, raw):
+        return round(1e-9 * (self.lat_offset + self.granularity * raw), 7)
+
+    def lon(self, raw):
+        return round(1e-9 * (self.lon_offset + self.granularity * raw), 7)
+
+    def timestamp(self, raw):
+        return self.convert_seconds(raw * self.date_granularity // 1000)
+
+    def timestamps(self, raws):
+        convert = self.convert_seconds
+        date_granularity = self.date_granularity
+        if date_granularity == 1000:
+            return [convert(raw) for raw in raws]
+        return [convert(raw * date_granularity // 1000) for raw in raws]
+
+    def user(self, sid):
+        return self.strings[sid] or None
+
+    def tags(self, keys, vals):
+        strings = self.strings
+        return [model.Tag(strings[k], strings[v]) for k, v in zip(keys, vals)]
+
+    def info(self, buf):
+        """Decode an Info message to (version, changeset, user, uid, visible, timestamp)."""
+        version = changeset = user = uid = visible = timestamp = None
+        if buf is None:
+            return version, changeset, user, uid, visible, timestamp
+
+        for field, value in _iter_fields(buf):
+            if field == 1:
+                version = _signed(value)
+            elif field == 2:
+                timestamp = self.timestamp(_signed(value))
+            elif field == 3:
+                changeset = _signed(value)
+            elif field == 4:
+                uid = _signed(value)
+            elif field == 5:
+                user = self.user(value)
+            elif field == 6:
+                visible = bool(value)
+
+        if version == -1:
+            version = None
+
+        return version, changeset, user, uid, visible, timestamp
+
+def _decode_node(block, buf):
+    node_id = lat = lon = info = None
+    keys = vals = ()
+    for field, value in _iter_fields(buf):
+        if field == 1:
+            node_id = _zigzag(value)
+        elif field == 2:
+            keys = _packed(value)
+        elif field == 3:
+            vals = _packed(value)
+        elif field == 4:
+            info = value
+        elif field == 8:
+            lat = _zigzag(value)
+        elif field == 9:
+            lon = _zigzag(value)
+
+    version, changeset, user, uid, visible, timestamp = block.info(info)
+    return model.Node(
+        node_id,
+        version,
+        changeset,
+        user,
+        uid,
+        visible,
+        timestamp,
+        block.lat(lat),
+        block.lon(lon),
+        block.tags(keys, vals)
+    )
+
+def _decode_dense_info(block, buf, count):
+    versions = timestamps = changesets = uids = user_sids = visibles = None
+    for field, value in _iter_fields(buf):
+        if field == 1:
+            versions = [_signed(v) for v in _packed(value)]
+        elif field == 2:
+            timestamps = block.timestamps(_packed_delta(value))
+        elif field == 3:
+            changesets = _packed_delta(value)
+        elif field == 4:
+            uids = _packed_delta(value)
+        elif field == 5:
+            user_sids = _packed_delta(value)
+        elif field == 6:
+            visibles = [bool(v) for v in _packed(value)]
+
+    nones = [None] * count
+    users = [block.user(sid) for sid in user_sids] if user_sids else nones
+    return (
+        versions or nones,
+        changesets or nones,
+        users,
+        uids or nones,
+        visibles or nones,
+        timestamps or nones,
+    )
+
+def _decode_dense(block, buf):
+    ids = lats = lons = keys_vals = info = None
+    for field, value in _iter_fields(buf):
+        if field == 1:
+            ids = _packed_delta(value)
+        elif field == 5:
+            info = value
+        elif field == 8:
+            lats = _packed_delta(value)
+        elif field == 9:
+            lons = _packed_delta(value)
+        elif field == 10:
+            keys_vals = _packed(value)
+
+    if not ids:
+        return []
+
+    count = len(ids)
+    if info is not None:
+        versions, changesets, users, uids, visibles, timestamps = _decode_dense_info(block, info, count)
+    else:
+        versions = changesets = users = uids = visibles = timestamps = [None] * count
+
+    # Scale every coordinate up front rather than calling block.lat and
+    # block.lon for each node.
+    granularity = block.granularity
+    lat_offset = block.lat_offset
+    lon_offset = block.lon_offset
+    lats = [round(1e-9 * (lat_offset + granularity * lat), 7) for lat in lats]
+    lons = [round(1e-9 * (lon_offset + granularity * lon), 7) for lon in lons]
+
+    strings = block.strings
+    kv_pos = 0
+    nodes = []
+    append = nodes.append
+    Node = model.Node
+    Tag = model.Tag
+    for node_id, version, changeset, user, uid, visible, timestamp, lat, lon in zip(
+            ids, versions, changesets, users, uids, visibles, timestamps, lats, lons):
+        tags = []
+        if keys_vals:
+            while keys_vals[kv_pos] != 0:
+                tags.append(Tag(strings[keys_vals[kv_pos]], strings[keys_vals[kv_pos + 1]]))
+                kv_pos += 2
+            kv_pos += 1
+
+        append(Node(node_id, version, changeset, user, uid, visible, timestamp, lat, lon, tags))
+
+    return nodes
+
+def _decode_way(block, buf):
+    way_id = info = None
+    keys = vals = refs = ()
+    for field, value in _iter_fields(buf):
+        if field == 1:
+            way_id = _signed(value)
+        elif field == 2:
+            keys = _packed(value)
+        elif field == 3:
+            vals = _packed(value)
+        elif field == 4:
+            info = value
+        elif field == 8:
+            refs = _packed_delta(value)
+
+    version, changeset, user, uid, visible, timestamp = block.info(info)
+    return model.Way(
+        way_id,
+        version,
+        changeset,
+        user,
+        uid,
+        visible,
+        timestamp,
+        list(refs),
+        block.tags(keys, vals)
+    )
+
+def _decode_relation(block, buf):
+    relation_id = info = None
+    keys = vals = roles = memids = types = ()
+    for field, value in _iter_fields(buf):
+        if field == 1:
+            relation_id = _signed(value)
+        elif field == 2:
+            keys = _packed(value)
+        elif field == 3:
+            vals = _packed(value)
+        elif field == 4:
+            info = value
+        elif field == 8:
+            roles = _packed(value)
+        elif field == 9:
+            memids = _packed_delta(value)
+        elif field == 10:
+            types = _packed(value)
+
+    strings = block.strings
+    version, changeset, user, uid, visible, timestamp = block.info(info)
+    return model.Relation(
+        relation_id,
+        version,
+        changeset,
+        user,
+        uid,
+        visible,
+        timestamp,
+        [model.Member(MEMBER_TYPES[t], ref, strings[r]) for t, ref, r in zip(types, memids, roles)],
+        block.tags(keys, vals)
+    )
+
+def _decode_primitive_block(buf, parse_timestamps):
+    """Decode an uncompressed PrimitiveBlock into a list of model objects."""
+    strings = []
+    groups = []
+    granularity = 100
+    date_granularity = 1000
+    lat_offset = 0
+    lon_offset = 0
+
+    for field, value in _iter_fields(buf):
+        if field == 1:
+            strings = [bytes(s).decode('utf-8') for f, s in _iter_fields(value) if f == 1]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            granularity = value
+        elif field == 18:
+            date_granularity = value
+        elif field == 19:
+            lat_offset = _signed(value)
+        elif field == 20:
+            lon_offset = _signed(value)
+
+    block = _Block(strings, granularity, date_granularity, lat_offset, lon_offset, parse_timestamps)
+
+    objects = []
+    for group in groups:
+        for field, value in _iter_fields(group):
+            if field == 1:
+                objects.append(_decode_node(block, value))
+            elif field == 2:
+                objects.extend(_decode_dense(block, value))
+            elif field == 3:
+                objects.append(_decode_way(block, value))
+            elif field == 4:
+                objects.append(_decode_relation(block, value))
+
+    return objects
+
+def _decode_blob(blob_type, data, parse_timestamps):
+    """Decompress and decode a single blob into a list of model objects."""
+    buf = _decompress_blob(data)
+    if blob_type == 'OSMHeader':
+        _check_header(buf)
+        return []
+    elif blob_type == 'OSMData':
+        return _decode_primitive_block(buf, parse_timestamps)
+    return []
+
+def _decode_blob_task(args):
+    return _decode_blob(*args)
+
+def iter_pbf_file(f, parse_timestamps=True, processes=None, max_in_flight=None):
+    """Parse a file-like or filename containing OSM PBF data and yield one OSM
+    primitive at a time to the caller, just like iter_osm_file does for XML.
+
+    If processes is greater than 1, blobs are decompressed and decoded in a pool
+    of that many worker processes. At most max_in_flight blobs (default: twice
+    the number of processes) are outstanding at once, and primitives are still
+    yielded in file order."""
+
+    if not hasattr(f, 'read'):
+        with open(f, 'rb') as fp:
+            for obj in iter_pbf_file(fp, parse_timestamps, processes, max_in_flight):
+                yield obj
+        return
+
+    if not processes or processes < 2:
+        for blob_type, data in _read_blobs(f):
+            for obj in _decode_blob(blob_type, data, parse_timestamps):
+                yield obj
+        return
+
+    tasks = ((blob_type, data, parse_timestamps) for blob_type, data in _read_blobs(f))
+    pool = multiprocessing.Pool(processes)
+    try:
+        for objects in imap_bounded(pool, _decode_blob_task, tasks, max_in_flight or processes * 2):
+            for obj in objects:
+                yield obj
+    finally:
+        pool.terminate()
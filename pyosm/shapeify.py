@@ -1,7 +1,20 @@
 from pyosm.parsing import iter_osm_file
 from pyosm.model import Node, Way, Relation
-from shapely.geometry import Point, LineString, Polygon
-from shapely.ops import polygonize
+from pyosm.filters import TagFilter
+from pyosm.idset import IdBitmap
+from pyosm.nodestore import make_node_store
+from pyosm.workers import imap_bounded
+from shapely.geometry import Point, LineString, Polygon, MultiPolygon
+from shapely.prepared import prep
+from shapely.wkb import loads as wkb_loads
+import array
+import collections
+import multiprocessing
+try:
+    from shapely.validation import make_valid
+except ImportError:
+    def make_valid(shape):
+        return shape.buffer(0)
 
 polygon_way_tags = {
     'area': ('yes'),
@@ -11,56 +24,413 @@ polygon_way_tags = {
 def way_is_polygon(way):
     return (way.nds[-1] == next(iter(way.nds))) and any([t.key in polygon_way_tags and t.value in polygon_way_tags[t.key] for t in way.tags])
 
-def get_shapes(filelike):
-    shapes = []
-    node_cache = {}
-    way_cache = {}
-    for thing in iter_osm_file(filelike):
-        if type(thing) == Node:
-            pt = (thing.lon, thing.lat)
-            shape = Point(pt)
-
-            node_cache[thing.id] = pt
-
-            if thing.tags:
-                shapes.append((thing, shape))
-
-        elif type(thing) == Way:
-            points = []
-            for nd in thing.nds:
-                node_loc = node_cache.get(nd)
-                if node_loc:
-                    points.append(node_loc)
-                else:
-                    raise Exception("Way %s references node %s which is not parsed yet." % (thing.id, nd))
-
-            if way_is_polygon(thing):
-                shape = Polygon(points)
+def relation_is_multipolygon(relation):
+    return any([t.key == 'type' and t.value == 'multipolygon' for t in relation.tags])
+
+def assemble_rings(ways):
+    """Chain (nds, points) way pieces into closed rings by joining ways that
+    share an endpoint node id, reversing pieces as needed. Returns a list of
+    closed coordinate lists; pieces that can't be closed are left out.
+
+    Endpoints are matched through a dict, so this runs in time linear in the
+    number of pieces rather than noding the geometries against each other."""
+
+    rings = []
+    by_endpoint = {}
+    open_ways = []
+    for nds, points in ways:
+        if len(nds) < 2:
+            continue
+        if nds[0] == nds[-1]:
+            if len(nds) >= 4:
+                rings.append(list(points))
+            continue
+        i = len(open_ways)
+        open_ways.append((nds, points))
+        by_endpoint.setdefault(nds[0], []).append(i)
+        by_endpoint.setdefault(nds[-1], []).append(i)
+
+    used = [False] * len(open_ways)
+    for i, (nds, points) in enumerate(open_ways):
+        if used[i]:
+            continue
+        used[i] = True
+        start = nds[0]
+        end = nds[-1]
+        ring = list(points)
+
+        while end != start:
+            candidates = by_endpoint.get(end, ())
+            j = next((j for j in candidates if not used[j]), None)
+            if j is None:
+                break
+            used[j] = True
+            next_nds, next_points = open_ways[j]
+            if next_nds[0] == end:
+                ring.extend(next_points[1:])
+                end = next_nds[-1]
             else:
-                shape = LineString(points)
+                ring.extend(reversed(next_points[:-1]))
+                end = next_nds[0]
+
+        if end == start and len(ring) >= 4:
+            rings.append(ring)
+
+    return rings
+
+def _bounds(ring):
+    xs = [p[0] for p in ring]
+    ys = [p[1] for p in ring]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def _bounds_contain(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] >= inner[2] and outer[3] >= inner[3]
+
+def multipolygon_rings(relation, way_cache):
+    """Assemble the member ways of a multipolygon relation, given a dict of way
+    id -> (nds, points), into (outer_rings, inner_rings). Ways with the 'inner'
+    role form inner rings and everything else forms outer rings."""
+
+    outer_ways = []
+    inner_ways = []
+    for member in relation.members:
+        if member.type != 'way':
+            continue
+        way = way_cache.get(member.ref)
+        if not way:
+            raise Exception("Relation %s references way %s which is not parsed yet." % (relation.id, member.ref))
+        if member.role == 'inner':
+            inner_ways.append(way)
+        else:
+            outer_ways.append(way)
+
+    return assemble_rings(outer_ways), assemble_rings(inner_ways)
+
+def polygon_from_rings(outer_rings, inner_rings):
+    """Put each inner ring into the smallest outer ring that contains it.
+    Returns a Polygon when there is a single outer ring, a MultiPolygon when
+    there are several, or None if there are no outer rings."""
+
+    outers = []
+    for ring in outer_rings:
+        shell = Polygon(ring)
+        outers.append((shell.area, _bounds(ring), ring, prep(shell), []))
+    if not outers:
+        return None
+    outers.sort(key=lambda outer: outer[0])
+
+    for ring in inner_rings:
+        bounds = _bounds(ring)
+        point = Point(ring[0])
+        for area, outer_bounds, shell_ring, prepared, holes in outers:
+            if _bounds_contain(outer_bounds, bounds) and prepared.intersects(point):
+                holes.append(ring)
+                break
+
+    polygons = [Polygon(shell_ring, holes) for area, bounds, shell_ring, prepared, holes in outers]
+    if len(polygons) == 1:
+        return polygons[0]
+    return MultiPolygon(polygons)
+
+def build_multipolygon(relation, way_cache):
+    """Build the geometry for a multipolygon relation from a dict of way id ->
+    (nds, points), using multipolygon_rings and polygon_from_rings. Returns
+    None if no outer ring could be closed."""
 
-            way_cache[thing.id] = points
+    return polygon_from_rings(*multipolygon_rings(relation, way_cache))
 
+def _count_relation_way_refs(relation, way_refs):
+    for member in relation.members:
+        if member.type == 'way':
+            way_refs[member.ref] = way_refs.get(member.ref, 0) + 1
+
+def _find_way_refs(filelike):
+    """Scan the relations in filelike and return a dict of way id -> number of
+    multipolygon relations that use the way."""
+
+    way_refs = {}
+    for relation in iter_osm_file(filelike, parse_timestamps=False, skip=('metadata',), element_filter=TagFilter(types=['relation'], values={'type': ['multipolygon']})):
+        _count_relation_way_refs(relation, way_refs)
+    return way_refs
+
+def _find_needed_ids(filelike):
+    """Scan the ways and relations in filelike and return a bitmap of the node
+    ids whose locations get_shapes will need, along with the multipolygon way
+    reference counts that _find_way_refs returns."""
+
+    needed_nodes = IdBitmap()
+    way_refs = {}
+    for thing in iter_osm_file(filelike, parse_timestamps=False, skip=('metadata',), element_filter=TagFilter(types=['way', 'relation'])):
+        if type(thing) == Way:
             if any(thing.tags):
-                # Only include tagged things at this point. Otherwise,
-                # the shapes that are part of multipolygon relations
-                # will be included twice.
-                shapes.append((thing, shape))
-
-        elif type(thing) == Relation:
-            if any([t.key == 'type' and t.value == 'multipolygon' for t in thing.tags]):
-                parts = []
-                for member in thing.members:
-                    if member.type == 'way':
-                        shape = way_cache.get(member.ref)
-                        if not shape:
-                            raise Exception("Relation %s references way %s which is not parsed yet." % (thing.id, member.ref))
-
-                        parts.append(shape)
-
-                # Polygonize will return all the polygons created, so the
-                # inner parts of the multipolygons will be returned twice
-                # we only want the first one
-                shapes.append((thing, next(polygonize(parts))))
-
-    return shapes
+                needed_nodes.update(thing.nds)
+        elif relation_is_multipolygon(thing):
+            _count_relation_way_refs(thing, way_refs)
+
+    # Relations come after the ways they use, so the nodes of untagged member
+    # ways can only be found with another look at the ways.
+    if way_refs:
+        _rewind(filelike)
+        for way in iter_osm_file(filelike, parse_timestamps=False, skip=('metadata', 'tags'), element_filter=TagFilter(types=['way'])):
+            if way.id in way_refs:
+                needed_nodes.update(way.nds)
+
+    return needed_nodes, way_refs
+
+def _rewind(filelike):
+    if hasattr(filelike, 'seek'):
+        filelike.seek(0)
+
+# Geometry kinds, as built by _build_shape from (kind, rings, inner_rings).
+# Points and linestrings have a single "ring" holding their coordinates.
+POINT, LINESTRING, POLYGON, MULTIPOLYGON = range(4)
+
+def _iter_shape_specs(filelike, node_store, two_pass, prescan_relations):
+    """Parse filelike and yield (primitive, kind, rings, inner_rings) for each
+    shape iter_shapes produces, with every coordinate already resolved."""
+
+    needed_nodes = way_refs = None
+    if two_pass:
+        needed_nodes, way_refs = _find_needed_ids(filelike)
+        _rewind(filelike)
+    elif prescan_relations:
+        way_refs = _find_way_refs(filelike)
+        _rewind(filelike)
+
+    owns_node_cache = node_store is None or isinstance(node_store, str)
+    node_cache = make_node_store(node_store)
+    way_cache = {}
+    try:
+        for thing in iter_osm_file(filelike):
+            if type(thing) == Node:
+                pt = (thing.lon, thing.lat)
+
+                if needed_nodes is None or thing.id in needed_nodes:
+                    node_cache[thing.id] = pt
+
+                if thing.tags:
+                    yield (thing, POINT, [[pt]], [])
+
+            elif type(thing) == Way:
+                if needed_nodes is not None and not any(thing.tags) and thing.id not in way_refs:
+                    continue
+
+                points = []
+                for nd in thing.nds:
+                    node_loc = node_cache.get(nd)
+                    if node_loc:
+                        points.append(node_loc)
+                    else:
+                        raise Exception("Way %s references node %s which is not parsed yet." % (thing.id, nd))
+
+                if way_refs is None or thing.id in way_refs:
+                    way_cache[thing.id] = (thing.nds, points)
+
+                if any(thing.tags):
+                    # Only include tagged things at this point. Otherwise,
+                    # the shapes that are part of multipolygon relations
+                    # will be included twice.
+                    yield (thing, POLYGON if way_is_polygon(thing) else LINESTRING, [points], [])
+
+            elif type(thing) == Relation:
+                if owns_node_cache and node_cache is not None:
+                    # Ways always come before relations, so node locations
+                    # aren't needed anymore.
+                    node_cache.close()
+                    node_cache = None
+
+                if relation_is_multipolygon(thing):
+                    outer_rings, inner_rings = multipolygon_rings(thing, way_cache)
+
+                    if way_refs is not None:
+                        for member in thing.members:
+                            if member.type == 'way':
+                                way_refs[member.ref] -= 1
+                                if not way_refs[member.ref]:
+                                    del way_refs[member.ref]
+                                    del way_cache[member.ref]
+
+                    # Relations whose rings don't close produce no shape
+                    if outer_rings:
+                        yield (thing, MULTIPOLYGON, outer_rings, inner_rings)
+    finally:
+        if owns_node_cache and node_cache is not None:
+            node_cache.close()
+
+def _build_shape(kind, rings, inner_rings, validate):
+    if kind == POINT:
+        shape = Point(rings[0][0])
+    elif kind == LINESTRING:
+        shape = LineString(rings[0])
+    elif kind == POLYGON:
+        shape = Polygon(rings[0])
+    else:
+        shape = polygon_from_rings(rings, inner_rings)
+
+    if validate and not shape.is_valid:
+        shape = make_valid(shape)
+    return shape
+
+def _pack_specs(specs):
+    """Flatten a batch of (kind, rings, inner_rings) into typed arrays that are
+    cheap to send to another process."""
+    kinds = array.array('b')
+    ring_counts = array.array('i')
+    ring_lengths = array.array('i')
+    coords = array.array('d')
+    for kind, rings, inner_rings in specs:
+        kinds.append(kind)
+        ring_counts.append(len(rings))
+        ring_counts.append(len(inner_rings))
+        for ring in rings + inner_rings:
+            ring_lengths.append(len(ring))
+            for x, y in ring:
+                coords.append(x)
+                coords.append(y)
+    return kinds, ring_counts, ring_lengths, coords
+
+def _unpack_specs(packed):
+    kinds, ring_counts, ring_lengths, coords = packed
+    ring = 0
+    pos = 0
+    for i, kind in enumerate(kinds):
+        parts = []
+        for n in range(ring_counts[2 * i] + ring_counts[2 * i + 1]):
+            length = ring_lengths[ring]
+            ring += 1
+            parts.append([(coords[j], coords[j + 1]) for j in range(pos, pos + 2 * length, 2)])
+            pos += 2 * length
+        outer = ring_counts[2 * i]
+        yield kind, parts[:outer], parts[outer:]
+
+def _build_wkb_batch(args):
+    packed, validate = args
+    return [_build_shape(kind, rings, inner_rings, validate).wkb for kind, rings, inner_rings in _unpack_specs(packed)]
+
+def iter_shapes(filelike, node_store=None, two_pass=False, prescan_relations=False, processes=None, batch_size=1000, validate=False, wkb=False):
+    """Parse OSM XML and yield (primitive, shape) tuples for tagged nodes,
+    tagged ways and multipolygon relations as soon as each one can be built.
+
+    node_store picks where node locations are kept while ways are built: 'dict'
+    (the default), 'dense' for a memory-mapped array indexed by node id, 'sparse'
+    for sorted arrays, or any store instance from pyosm.nodestore. Node
+    locations are released once the relations start.
+
+    With prescan_relations=True the multipolygon relations are scanned first,
+    so only the coordinates of ways they use are cached, and each way's
+    coordinates are freed once the last relation using it has been built.
+    Multipolygon geometry is put together by build_multipolygon.
+
+    two_pass=True does that and also scans the ways, so that only the
+    locations of nodes that end up in a shape are kept.
+
+    Either option needs filelike to be a filename or a seekable file.
+
+    validate=True repairs invalid geometries with make_valid, and wkb=True
+    yields the shapes as WKB bytes instead of Shapely objects.
+
+    With processes greater than 1, coordinates are resolved while parsing and
+    shipped in batches of batch_size shapes as flat arrays to a pool of worker
+    processes, which build (and validate) the geometries and send back WKB.
+    Shapes still come out in file order, and parsing overlaps geometry work."""
+
+    specs = _iter_shape_specs(filelike, node_store, two_pass, prescan_relations)
+
+    if not processes or processes < 2:
+        for thing, kind, rings, inner_rings in specs:
+            shape = _build_shape(kind, rings, inner_rings, validate)
+            yield (thing, shape.wkb if wkb else shape)
+        return
+
+    pending = collections.deque()
+
+    def batches():
+        things = []
+        batch = []
+        for thing, kind, rings, inner_rings in specs:
+            things.append(thing)
+            batch.append((kind, rings, inner_rings))
+            if len(batch) >= batch_size:
+                pending.append(things)
+                yield (_pack_specs(batch), validate)
+                things = []
+                batch = []
+        if batch:
+            pending.append(things)
+            yield (_pack_specs(batch), validate)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for shapes in imap_bounded(pool, _build_wkb_batch, batches(), processes * 2):
+            for thing, shape in zip(pending.popleft(), shapes):
+                yield (thing, shape if wkb else wkb_loads(shape))
+    finally:
+        pool.terminate()
+
+def _build_shape_array(specs, validate):
+    """Build a NumPy object array of geometries for a batch of specs using
+    Shapely 2's vectorized constructors. Only multipolygons, whose holes have
+    to be matched to their shells, are built one at a time."""
+
+    import numpy
+    import shapely
+
+    geoms = numpy.empty(len(specs), dtype=object)
+
+    for kind, make in ((POINT, None), (LINESTRING, shapely.linestrings), (POLYGON, shapely.linearrings)):
+        positions = [i for i, spec in enumerate(specs) if spec[0] == kind]
+        if not positions:
+            continue
+        rings = [specs[i][1][0] for i in positions]
+        coords = numpy.array([pt for ring in rings for pt in ring], dtype=numpy.float64)
+        if kind == POINT:
+            geoms[positions] = shapely.points(coords)
+            continue
+        indices = numpy.repeat(numpy.arange(len(rings)), [len(ring) for ring in rings])
+        built = make(coords, indices=indices)
+        if kind == POLYGON:
+            built = shapely.polygons(built)
+        geoms[positions] = built
+
+    for i, (kind, rings, inner_rings) in enumerate(specs):
+        if kind == MULTIPOLYGON:
+            geoms[i] = polygon_from_rings(rings, inner_rings)
+
+    if validate:
+        invalid = ~shapely.is_valid(geoms)
+        if invalid.any():
+            geoms[invalid] = shapely.make_valid(geoms[invalid])
+
+    return geoms
+
+def iter_wkb_batches(filelike, batch_size=10000, node_store=None, two_pass=False, prescan_relations=False, validate=False):
+    """Parse OSM XML and yield (primitives, wkbs) tuples for batches of up to
+    batch_size shapes, where wkbs is a NumPy array of WKB bytes that lines up
+    with the list of primitives. Geometries are built a batch at a time with
+    Shapely 2's vectorized constructors rather than one object per feature.
+    See iter_shapes for the other options."""
+
+    import shapely
+
+    if not hasattr(shapely, 'to_wkb'):
+        raise Exception('iter_wkb_batches needs Shapely 2 or later')
+
+    things = []
+    specs = []
+    for thing, kind, rings, inner_rings in _iter_shape_specs(filelike, node_store, two_pass, prescan_relations):
+        things.append(thing)
+        specs.append((kind, rings, inner_rings))
+        if len(specs) >= batch_size:
+            yield things, shapely.to_wkb(_build_shape_array(specs, validate))
+            things = []
+            specs = []
+
+    if specs:
+        yield things, shapely.to_wkb(_build_shape_array(specs, validate))
+
+def get_shapes(filelike, node_store=None, two_pass=False, prescan_relations=False, processes=None, batch_size=1000, validate=False, wkb=False):
+    """Parse OSM XML and return a list of (primitive, shape) tuples for tagged
+    nodes, tagged ways and multipolygon relations. See iter_shapes for the
+    options."""
+
+    return list(iter_shapes(filelike, node_store, two_pass, prescan_relations, processes, batch_size, validate, wkb))
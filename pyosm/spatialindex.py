@@ -0,0 +1,158 @@
+import numpy
+import shapely
+from shapely.geometry import Point, box
+from pyosm.model import Node, Way, Relation, CompactNode, CompactWay, CompactRelation, Tag
+
+# The on-disk format is this magic string followed by an uncompressed
+# numpy.savez archive of plain arrays, which is loaded with allow_pickle=False
+# so that opening an index file can't run code:
+#
+#   kinds           uint8, 0 for a node, 1 for a way, 2 for a relation
+#   ids             int64 primitive ids
+#   wkb             uint8, every shape's WKB concatenated
+#   wkb_offsets     int64, where each shape's WKB starts, plus the total length
+#   tag_counts      int64, the number of tags on each primitive
+#   strings         uint8, the UTF-8 keys and values of every tag in order
+#   string_offsets  int64, where each key and value starts, plus the total
+_MAGIC = b'PYOSM-SHAPEINDEX-2\n'
+
+_KINDS = {
+    Node: 0,
+    CompactNode: 0,
+    Way: 1,
+    CompactWay: 1,
+    Relation: 2,
+    CompactRelation: 2,
+}
+
+def _concat(chunks):
+    """Join byte strings into a uint8 array and the offsets of each one."""
+    offsets = numpy.zeros(len(chunks) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(c) for c in chunks], out=offsets[1:])
+    return numpy.frombuffer(b''.join(chunks), dtype=numpy.uint8), offsets
+
+def _split(data, offsets):
+    data = data.tobytes()
+    return [data[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+def _primitive(kind, primitive_id, tags, shape):
+    if kind == 0:
+        return Node(primitive_id, None, None, None, None, None, None, shape.y, shape.x, tags)
+    elif kind == 1:
+        return Way(primitive_id, None, None, None, None, None, None, None, tags)
+    return Relation(primitive_id, None, None, None, None, None, None, None, tags)
+
+class ShapeIndex(object):
+    """An STR-tree index over (primitive, shape) pairs, such as the output of
+    pyosm.shapeify.get_shapes, for bounding box, nearest and point-in-polygon
+    queries. Shapes can be Shapely geometries or WKB bytes. The tree is bulk
+    loaded once from every shape, so build a new index to add more.
+
+    Coordinates are (lon, lat) and queries return lists of (primitive, shape)
+    tuples. Needs Shapely 2.
+
+    save writes an index to a file that load can restore without parsing the
+    OSM data again. Only the type, id and tags of each primitive are saved, so
+    loaded primitives are Node, Way and Relation objects with their other
+    fields set to None, except that nodes get lat and lon from their point."""
+
+    def __init__(self, shapes=()):
+        if not hasattr(shapely, 'STRtree') or not hasattr(shapely, 'from_wkb'):
+            raise Exception('ShapeIndex needs Shapely 2 or later')
+
+        self.primitives = []
+        geoms = []
+        for primitive, shape in shapes:
+            self.primitives.append(primitive)
+            geoms.append(shape)
+
+        self.shapes = numpy.empty(len(geoms), dtype=object)
+        self.shapes[:] = [shapely.from_wkb(g) if isinstance(g, bytes) else g for g in geoms]
+        self._tree = shapely.STRtree(self.shapes)
+
+    @classmethod
+    def from_nodes(cls, nodes):
+        """Index the nodes from parse_osm_file (or any Node objects) as points."""
+        return cls((n, Point(n.lon, n.lat)) for n in nodes if n.lat is not None and n.lon is not None)
+
+    def __len__(self):
+        return len(self.primitives)
+
+    def __iter__(self):
+        return iter(zip(self.primitives, self.shapes))
+
+    def _results(self, indexes):
+        return [(self.primitives[i], self.shapes[i]) for i in sorted(indexes)]
+
+    def query_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """Return the shapes that intersect the given bounding box."""
+        return self._results(self._tree.query(box(min_lon, min_lat, max_lon, max_lat), predicate='intersects'))
+
+    def query_point(self, lon, lat):
+        """Return the shapes that contain the given point, including any the
+        point lies on the boundary of."""
+        return self._results(self._tree.query(Point(lon, lat), predicate='intersects'))
+
+    def nearest(self, lon, lat, max_distance=None):
+        """Return the shape closest to the given point, or None if the index is
+        empty or nothing is within max_distance degrees. Ties return the shape
+        that was added first."""
+        if not len(self.primitives):
+            return None
+        indexes = self._tree.query_nearest(Point(lon, lat), max_distance=max_distance)
+        if not len(indexes):
+            return None
+        return self._results(indexes)[0]
+
+    def save(self, path):
+        """Write the index to path so that ShapeIndex.load can restore it
+        without re-parsing the OSM data."""
+        kinds = numpy.empty(len(self.primitives), dtype=numpy.uint8)
+        ids = numpy.empty(len(self.primitives), dtype=numpy.int64)
+        tag_counts = numpy.zeros(len(self.primitives), dtype=numpy.int64)
+        strings = []
+        for i, primitive in enumerate(self.primitives):
+            kind = _KINDS.get(type(primitive))
+            if kind is None:
+                raise Exception('Can\'t save a %s in a ShapeIndex' % type(primitive).__name__)
+            kinds[i] = kind
+            ids[i] = primitive.id
+            for tag in primitive.tags or ():
+                strings.append(tag.key.encode('utf-8'))
+                strings.append(tag.value.encode('utf-8'))
+                tag_counts[i] += 1
+
+        wkb, wkb_offsets = _concat(list(shapely.to_wkb(self.shapes)))
+        strings, string_offsets = _concat(strings)
+
+        with open(path, 'wb') as f:
+            f.write(_MAGIC)
+            numpy.savez(f, kinds=kinds, ids=ids, wkb=wkb, wkb_offsets=wkb_offsets,
+                tag_counts=tag_counts, strings=strings, string_offsets=string_offsets)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise Exception('%s is not a saved ShapeIndex' % path)
+            with numpy.load(f, allow_pickle=False) as data:
+                kinds = data['kinds']
+                ids = data['ids']
+                wkbs = _split(data['wkb'], data['wkb_offsets'])
+                tag_counts = data['tag_counts']
+                strings = [s.decode('utf-8') for s in _split(data['strings'], data['string_offsets'])]
+
+        index = cls.__new__(cls)
+        index.shapes = numpy.empty(len(wkbs), dtype=object)
+        index.shapes[:] = shapely.from_wkb(numpy.array(wkbs, dtype=object))
+
+        index.primitives = []
+        position = 0
+        for kind, primitive_id, count, shape in zip(kinds.tolist(), ids.tolist(), tag_counts.tolist(), index.shapes):
+            end = position + 2 * count
+            tags = [Tag(strings[i], strings[i + 1]) for i in range(position, end, 2)]
+            position = end
+            index.primitives.append(_primitive(kind, primitive_id, tags, shape))
+
+        index._tree = shapely.STRtree(index.shapes)
+        return index
@@ -0,0 +1,31 @@
+import collections
+
+def _next_ready(pending, poll_interval=0.05):
+    """Remove and return the result of whichever pending task finishes first."""
+    while True:
+        for i, result in enumerate(pending):
+            if result.ready():
+                del pending[i]
+                return result.get()
+        pending[0].wait(poll_interval)
+
+def imap_bounded(pool, func, iterable, max_in_flight, ordered=True):
+    """Like pool.imap, but never submits more than max_in_flight tasks ahead
+    of the consumer so memory use stays bounded. Results are yielded in the
+    order of the input iterable unless ordered is False, in which case they
+    are yielded as soon as each one finishes."""
+
+    pending = collections.deque()
+    for args in iterable:
+        if len(pending) >= max_in_flight:
+            if ordered:
+                yield pending.popleft().get()
+            else:
+                yield _next_ready(pending)
+        pending.append(pool.apply_async(func, (args,)))
+
+    while pending:
+        if ordered:
+            yield pending.popleft().get()
+        else:
+            yield _next_ready(pending)
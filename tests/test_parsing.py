@@ -0,0 +1,172 @@
+import bz2
+import datetime
+import gzip
+import io
+import os.path
+import pytest
+from pyosm.filters import TagFilter
+from pyosm.model import Changeset, Member, Node, Relation, Tag, Way, CompactNode, CompactWay, CompactRelation
+from pyosm.parsing import iter_osm_file, iter_osm_change_file, parse_osm_file, _DecompressingReader
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+def _path(name):
+    return os.path.join(FIXTURES, name)
+
+def _osm(**kwargs):
+    return list(iter_osm_file(_path('small.osm'), **kwargs))
+
+def _ids(objects):
+    return [(type(obj).__name__, obj.id) for obj in objects]
+
+def test_osm_file():
+    objects = _osm()
+    assert _ids(objects) == [
+        ('Node', 1), ('Node', 2), ('Node', 3), ('Node', 7), ('Node', 8),
+        ('Way', 20), ('Way', 21), ('Relation', 30), ('Relation', 31),
+    ]
+    assert objects[0] == Node(1, 1, 10, u'alice', 100, True, datetime.datetime(2012, 3, 4, 5, 6, 7), 51.5073509, -0.1277583, [])
+    assert objects[1].tags == [Tag(u'amenity', u'cafe'), Tag(u'name', u'Caf\xe9 <&> "Zo\xeb"')]
+    assert objects[3].user == u'\xf1and\xfa'
+    assert objects[5] == Way(20, 2, 14, u'alice', 100, True, datetime.datetime(2020, 2, 29, 12, 0, 0), [1, 2, 3, 1], [Tag(u'building', u'yes')])
+    assert objects[8] == Relation(31, 4, 16, u'\xf1and\xfa', 102, True, datetime.datetime(2021, 1, 1, 0, 0, 1),
+        [Member(u'relation', 30, u'subarea'), Member(u'way', 21, u'outer')], [Tag(u'type', u'boundary')])
+
+def test_timestamp_modes():
+    assert _osm(parse_timestamps=False)[0].timestamp == '2012-03-04T05:06:07Z'
+    assert _osm(parse_timestamps='epoch')[0].timestamp == 1330837567
+    assert _osm(parse_timestamps='epoch')[2].timestamp == 946684799
+
+def test_file_like():
+    with open(_path('small.osm'), 'rb') as f:
+        assert list(iter_osm_file(f)) == _osm()
+
+def test_change_file():
+    with open(_path('small.osc'), 'rb') as f:
+        changes = list(iter_osm_change_file(f))
+
+    assert [(action, type(obj).__name__, obj.id) for action, obj in changes] == [
+        ('create', 'Node', 9), ('create', 'Way', 22),
+        ('modify', 'Node', 2), ('modify', 'Relation', 30),
+        ('delete', 'Node', 3),
+    ]
+    assert changes[1][1].nds == [9, 8]
+    assert changes[3][1].members == [Member(u'way', 20, u'outer')]
+    assert changes[4][1] == Node(3, 3, 22, u'\xf1and\xfa', 102, False, datetime.datetime(2022, 5, 6, 7, 10), None, None, [])
+
+def test_changesets():
+    changesets = list(iter_osm_file(_path('changesets.osm')))
+    assert changesets == [
+        Changeset(20, datetime.datetime(2022, 5, 6, 7, 8), datetime.datetime(2022, 5, 6, 7, 9), False, 1.5, 10.25, -2.25, 20.5, u'alice', 100,
+            [Tag(u'comment', u'Add bakery'), Tag(u'created_by', u'JOSM/1.5')]),
+        Changeset(23, datetime.datetime(2022, 5, 6, 8, 0), None, True, None, None, None, None, u'\xf1and\xfa', 102, []),
+    ]
+
+## skip=
+
+def test_skip_tags_and_metadata():
+    full = _osm()
+    for obj, skipped in zip(full, _osm(skip=('tags', 'metadata'))):
+        assert skipped.tags is None
+        assert (skipped.version, skipped.changeset, skipped.user, skipped.uid, skipped.visible, skipped.timestamp) == (None,) * 6
+        assert skipped.id == obj.id
+
+    nodes = _osm(skip=('metadata',))[:5]
+    assert [(n.lat, n.lon, n.tags) for n in nodes] == [(n.lat, n.lon, n.tags) for n in full[:5]]
+
+def test_skip_nds_and_members():
+    objects = _osm(skip=('nds', 'members'))
+    assert objects[5].nds is None
+    assert objects[7].members is None
+    assert objects[7].tags == [Tag(u'type', u'multipolygon')]
+
+def test_skip_unknown_field():
+    with pytest.raises(Exception):
+        _osm(skip=('geometry',))
+
+def test_skip_change_file():
+    with open(_path('small.osc'), 'rb') as f:
+        changes = list(iter_osm_change_file(f, skip=('tags',)))
+    assert [obj.tags for action, obj in changes] == [None] * 5
+    assert [action for action, obj in changes] == ['create', 'create', 'modify', 'modify', 'delete']
+
+## element_filter= and keep_way_nodes=
+
+def test_element_filter():
+    assert _ids(_osm(element_filter=TagFilter(types=['node'], keys=['amenity']))) == [('Node', 2)]
+    assert _ids(_osm(element_filter=TagFilter(types=['way', 'relation']))) == [('Way', 20), ('Way', 21), ('Relation', 30), ('Relation', 31)]
+    assert _ids(_osm(element_filter=TagFilter(values={'type': ['boundary']}))) == [('Relation', 31)]
+    assert _ids(_osm(element_filter=TagFilter(exclude_keys=['name', 'amenity', 'name:ja']), skip=('tags',)))[:3] == [('Node', 1), ('Node', 3), ('Node', 8)]
+
+def test_keep_way_nodes():
+    building = TagFilter(types=['way'], keys=['building'])
+    assert _ids(_osm(element_filter=building)) == [('Way', 20)]
+
+    objects = _osm(element_filter=building, keep_way_nodes=True)
+    assert _ids(objects) == [('Node', 1), ('Node', 2), ('Node', 3), ('Way', 20)]
+    assert objects[:3] == _osm()[:3]
+
+    # Works on a seekable file too, which is read twice
+    with open(_path('small.osm'), 'rb') as f:
+        f.read(10)
+        f.seek(0)
+        assert list(iter_osm_file(f, element_filter=building, keep_way_nodes=True)) == objects
+
+## compact=
+
+def _expanded(obj):
+    values = []
+    for field in obj._fields:
+        value = getattr(obj, field)
+        values.append(list(value) if field == 'nds' else value)
+    return values
+
+def test_compact():
+    full = _osm()
+    compact = _osm(compact=True)
+    assert [type(obj) for obj in compact] == [CompactNode] * 5 + [CompactWay] * 2 + [CompactRelation] * 2
+    for obj, small in zip(full, compact):
+        assert _expanded(small) == list(obj)
+
+    assert len(set(compact)) == len(compact)
+    assert compact == _osm(compact=True)
+
+def test_compact_with_skip_and_filter():
+    objects = _osm(compact=True, skip=('metadata',), element_filter=TagFilter(types=['way'], keys=['building']), keep_way_nodes=True)
+    assert [type(obj) for obj in objects] == [CompactNode] * 3 + [CompactWay]
+    assert list(objects[3].nds) == [1, 2, 3, 1]
+    assert objects[0].version is None
+
+def test_parse_osm_file_compact():
+    nodes, ways, relations = parse_osm_file(_path('small.osm'), compact=True)
+    assert (len(nodes), len(ways), len(relations)) == (5, 2, 2)
+    assert nodes[1].tags == [Tag(u'amenity', u'cafe'), Tag(u'name', u'Caf\xe9 <&> "Zo\xeb"')]
+
+## Streaming decompression
+
+def _read_all(reader):
+    chunks = []
+    while True:
+        data = reader.read(1000)
+        if not data:
+            return b''.join(chunks)
+        chunks.append(data)
+
+def test_decompressing_reader():
+    with open(_path('small.osm'), 'rb') as f:
+        raw = f.read()
+    members = gzip.compress(raw[:700]) + gzip.compress(raw[700:])
+    for compression, data in (('gzip', gzip.compress(raw)), ('gzip', members), ('bz2', bz2.compress(raw))):
+        for block_size in (7, 65536):
+            assert _DecompressingReader(io.BytesIO(data), compression, block_size).read() == raw
+            assert _read_all(_DecompressingReader(io.BytesIO(data), compression, block_size)) == raw
+
+def test_decompressing_reader_truncated():
+    with open(_path('small.osm'), 'rb') as f:
+        raw = f.read()
+    for compression, data in (('gzip', gzip.compress(raw)), ('bz2', bz2.compress(raw))):
+        for block_size in (7, 65536):
+            with pytest.raises(EOFError):
+                _DecompressingReader(io.BytesIO(data[:len(data) // 2]), compression, block_size).read()
+            with pytest.raises(EOFError):
+                _read_all(_DecompressingReader(io.BytesIO(data[:-1]), compression, block_size))
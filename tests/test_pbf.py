@@ -0,0 +1,32 @@
+import os.path
+from pyosm.parsing import iter_osm_file
+from pyosm.pbf import iter_pbf_file, _packed, _packed_delta
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+# small.osm.pbf and small-nodense.osm.pbf were written from small.osm by
+# pyosmium, with and without DenseNodes. PBF files without history don't
+# carry the visible flag, so that is left out of the comparison.
+
+def _xml(parse_timestamps):
+    return [obj._replace(visible=None) for obj in iter_osm_file(os.path.join(FIXTURES, 'small.osm'), parse_timestamps)]
+
+def _pbf(name, parse_timestamps, processes=None):
+    return list(iter_pbf_file(os.path.join(FIXTURES, name), parse_timestamps, processes))
+
+def test_dense_nodes_match_xml():
+    for parse_timestamps in (True, False, 'epoch'):
+        assert _pbf('small.osm.pbf', parse_timestamps) == _xml(parse_timestamps)
+
+def test_plain_nodes_match_xml():
+    for parse_timestamps in (True, False, 'epoch'):
+        assert _pbf('small-nodense.osm.pbf', parse_timestamps) == _xml(parse_timestamps)
+
+def test_process_pool_matches_xml():
+    assert _pbf('small.osm.pbf', True, processes=2) == _xml(True)
+
+def test_packed_varints():
+    # 1, 300 and 2**35 as varints
+    assert _packed(bytearray(b'\x01\xac\x02\x80\x80\x80\x80\x80\x01')) == [1, 300, 2 ** 35]
+    # Zigzag deltas +1, -2, +150 from zero
+    assert _packed_delta(bytearray(b'\x02\x03\xac\x02')) == [1, -1, 149]
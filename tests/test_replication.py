@@ -0,0 +1,277 @@
+import asyncio
+import datetime
+import functools
+import gzip
+import os
+import threading
+import time
+import pytest
+
+try:
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    pytest.skip('These tests need Python 3.7 or later', allow_module_level=True)
+
+import pyosm.aio as aio
+import pyosm.httpclient as httpclient
+import pyosm.parsing as parsing
+from pyosm import model
+from pyosm.cache import DiskCache
+from pyosm.parsing import find_sequence_for_timestamp, iter_osm_stream
+
+# Each test gets its own minute feed in a temporary directory, served over
+# HTTP/1.1 keep-alive. Sequence n is published at BASE + n minutes, and its
+# diff creates node n.
+
+BASE = datetime.datetime(2020, 1, 1)
+
+class _Handler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.server.truncate.get(self.path):
+            # Promise the whole file but hang up half way through it
+            self.server.truncate[self.path] -= 1
+            with open(self.translate_path(self.path), 'rb') as f:
+                data = f.read()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data[:len(data) // 2])
+            self.close_connection = True
+            return
+        SimpleHTTPRequestHandler.do_GET(self)
+
+class _Feed(object):
+
+    def __init__(self, root, url, server):
+        self.root = root
+        self.url = url
+        self.server = server
+
+    def path(self, sequence, suffix):
+        return parsing._sequence_url(self.root, sequence, suffix)
+
+    def diff_url(self, sequence):
+        return parsing._sequence_url(self.url, sequence, '.osc.gz')
+
+    def publish(self, sequence, timestamp=None, diff=None):
+        timestamp = timestamp or BASE + datetime.timedelta(minutes=sequence)
+        if not os.path.exists(os.path.dirname(self.path(sequence, ''))):
+            os.makedirs(os.path.dirname(self.path(sequence, '')))
+        if diff is None:
+            diff = gzip.compress((
+                '<osmChange version="0.6"><create><node id="%d" version="1" changeset="1" user="u" uid="1" '
+                'timestamp="%s" lat="1.0" lon="2.0"/></create></osmChange>' % (sequence, timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'))
+            ).encode('utf-8'))
+        with open(self.path(sequence, '.osc.gz'), 'wb') as f:
+            f.write(diff)
+        state = 'sequenceNumber=%d\ntimestamp=%s\n' % (sequence, timestamp.strftime('%Y-%m-%dT%H\\:%M\\:%SZ'))
+        # The state file goes last, as on the real servers
+        for name in (self.path(sequence, '.state.txt'), os.path.join(self.root, 'state.txt')):
+            with open(name + '.tmp', 'w') as f:
+                f.write(state)
+            os.rename(name + '.tmp', name)
+
+    def requests(self, suffix):
+        return [path for path in self.server.requests if path.endswith(suffix)]
+
+@pytest.fixture
+def feed(tmp_path, monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(_Handler, directory=str(tmp_path)))
+    server.requests = []
+    server.truncate = {}
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    previous = httpclient.default_client()
+    httpclient.set_default_client(httpclient.HTTPClient(timeout=5, backoff=0.01))
+
+    # Keep probed sequence times out of ~/.cache
+    find = functools.partial(find_sequence_for_timestamp, cache_file=None)
+    monkeypatch.setattr(parsing, 'find_sequence_for_timestamp', find)
+    monkeypatch.setattr(aio, 'find_sequence_for_timestamp', find)
+
+    feed = _Feed(str(tmp_path / 'minute'), 'http://127.0.0.1:%d/minute' % server.server_address[1], server)
+    for sequence in range(30):
+        feed.publish(sequence)
+    try:
+        yield feed
+    finally:
+        httpclient.default_client().close()
+        httpclient.set_default_client(previous)
+        server.shutdown()
+        server.server_close()
+
+def _until(stream, last):
+    """Consume stream up to the Finished marker for sequence last."""
+    items = []
+    try:
+        for item in stream:
+            items.append(item)
+            if type(item[1]) is model.Finished and int(item[1].sequence) == last:
+                return items
+    finally:
+        stream.close()
+    return items
+
+def _summary(items):
+    return [obj.sequence if type(obj) is model.Finished else (action, obj.id) for action, obj in items]
+
+def _expected(first, last):
+    summary = []
+    for sequence in range(first, last + 1):
+        summary.extend([('create', sequence), str(sequence)])
+    return summary
+
+def _temp_files(path):
+    return [name for name in os.listdir(path) if name.startswith('.')]
+
+## Streaming and prefetching (user-019, user-020)
+
+def test_stream(feed):
+    items = _until(iter_osm_stream(3, feed.url), 12)
+    assert _summary(items) == _expected(3, 12)
+    assert items[1][1].timestamp == BASE + datetime.timedelta(minutes=3)
+
+def test_prefetch_order(feed):
+    items = _until(iter_osm_stream(3, feed.url, prefetch=4), 29)
+    assert _summary(items) == _expected(3, 29)
+
+    # Every file is fetched once, and the latest state only at the start
+    assert len(feed.requests('/minute/state.txt')) == 1
+    assert sorted(feed.requests('.osc.gz')) == sorted(set(feed.requests('.osc.gz')))
+    assert len(feed.requests('.osc.gz')) == 27
+    assert len(feed.requests('.state.txt')) == 27
+
+def test_retry_truncated_diff(feed):
+    for sequence in (4, 5, 8):
+        feed.server.truncate['/minute' + feed.diff_url(sequence).split('/minute')[1]] = 1
+    assert _summary(_until(iter_osm_stream(3, feed.url), 9)) == _expected(3, 9)
+    assert _summary(_until(iter_osm_stream(3, feed.url, prefetch=3), 9)) == _expected(3, 9)
+
+def test_truncated_gzip(feed):
+    with open(feed.path(6, '.osc.gz'), 'rb') as f:
+        data = f.read()
+    feed.publish(6, diff=data[:-4])
+    with pytest.raises(EOFError):
+        _until(iter_osm_stream(6, feed.url), 6)
+
+## Disk cache (user-024)
+
+def test_offline_replay(feed, tmp_path):
+    path = str(tmp_path / 'cache')
+    online = _until(iter_osm_stream(3, feed.url, cache=DiskCache(path)), 12)
+    requests = len(feed.server.requests)
+
+    offline = list(iter_osm_stream(3, feed.url, cache=DiskCache(path, offline=True)))
+    assert _summary(offline) == _summary(online) == _expected(3, 12)
+    assert len(feed.server.requests) == requests
+    assert _temp_files(path) == []
+
+    # A sequence the cache doesn't have ends the stream, even the first one
+    assert list(iter_osm_stream(20, feed.url, cache=DiskCache(path, offline=True))) == []
+
+def test_prefetch_through_cache(feed, tmp_path):
+    path = str(tmp_path / 'cache')
+    _until(iter_osm_stream(3, feed.url, prefetch=4, cache=DiskCache(path)), 29)
+    replay = list(iter_osm_stream(3, feed.url, cache=DiskCache(path, offline=True)))
+    assert _summary(replay) == _expected(3, 29)
+
+def test_eviction(feed, tmp_path):
+    path = str(tmp_path / 'cache')
+    cache = DiskCache(path, max_bytes=2000)
+    _until(iter_osm_stream(0, feed.url, cache=cache), 29)
+
+    sizes = [os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)]
+    assert sum(sizes) == cache._size <= 2000
+    assert len(sizes) < 60
+    # The most recent diffs are the ones kept
+    assert feed.diff_url(29) in cache
+    assert feed.diff_url(0) not in cache
+    assert DiskCache(path)._size == cache._size
+
+def test_truncated_download_not_cached(feed, tmp_path):
+    path = str(tmp_path / 'cache')
+    cache = DiskCache(path)
+    url = feed.diff_url(7)
+    feed.server.truncate['/minute' + url.split('/minute')[1]] = 100
+    with pytest.raises(Exception):
+        _until(iter_osm_stream(7, feed.url, cache=cache), 7)
+    assert url not in cache
+    assert _temp_files(path) == []
+
+    # Nor is a whole download of a truncated gzip file
+    with open(feed.path(8, '.osc.gz'), 'rb') as f:
+        data = f.read()
+    feed.publish(8, diff=data[:-4])
+    with pytest.raises(EOFError):
+        _until(iter_osm_stream(8, feed.url, cache=cache), 8)
+    assert feed.diff_url(8) not in cache
+    assert _temp_files(path) == []
+
+def test_early_stop_not_cached(feed, tmp_path):
+    path = str(tmp_path / 'cache')
+    cache = DiskCache(path)
+    stream = iter_osm_stream(3, feed.url, cache=cache)
+    next(stream)
+    stream.close()
+    assert feed.diff_url(3) not in cache
+    assert _temp_files(path) == []
+
+def test_stale_downloads_removed(tmp_path):
+    path = str(tmp_path / 'cache')
+    os.makedirs(path)
+    for name, age in (('.download-old', 7200), ('.download-new', 10), ('entry', 7200)):
+        with open(os.path.join(path, name), 'wb') as f:
+            f.write(b'x' * 100)
+        os.utime(os.path.join(path, name), (time.time() - age, time.time() - age))
+
+    cache = DiskCache(path)
+    assert sorted(os.listdir(path)) == ['.download-new', 'entry']
+    assert cache._size == 100
+
+## Finding sequences by time (user-022)
+
+def test_find_sequence_for_timestamp(feed):
+    find = parsing.find_sequence_for_timestamp
+    assert find(feed.url, BASE + datetime.timedelta(minutes=10)) == 11
+    assert find(feed.url, BASE + datetime.timedelta(minutes=10, seconds=30)) == 11
+    assert find(feed.url, BASE + datetime.timedelta(minutes=10, seconds=-1)) == 10
+    assert find(feed.url, BASE - datetime.timedelta(days=1)) == 0
+    # At or after the latest state, the answer is the next one to be published
+    assert find(feed.url, BASE + datetime.timedelta(minutes=29)) == 30
+    assert find(feed.url, datetime.datetime.utcnow()) == 30
+
+def test_start_time(feed):
+    items = _until(iter_osm_stream(base_url=feed.url, start_time=BASE + datetime.timedelta(minutes=20, seconds=5)), 22)
+    assert _summary(items) == _expected(21, 22)
+
+def _publish_soon(feed, sequence):
+    def publish():
+        time.sleep(0.5)
+        feed.publish(sequence, datetime.datetime.utcnow())
+    thread = threading.Thread(target=publish)
+    thread.start()
+    return thread
+
+def test_start_time_now(feed):
+    thread = _publish_soon(feed, 30)
+    items = _until(iter_osm_stream(base_url=feed.url, start_time=datetime.datetime.utcnow()), 30)
+    thread.join()
+    assert _summary(items) == _expected(30, 30)
+
+def test_async_start_time_now(feed):
+    async def first():
+        async for action, obj in aio.aiter_osm_stream(base_url=feed.url, start_time=datetime.datetime.utcnow()):
+            if type(obj) is model.Finished:
+                return obj.sequence
+
+    thread = _publish_soon(feed, 30)
+    assert asyncio.get_event_loop().run_until_complete(first()) == '30'
+    thread.join()
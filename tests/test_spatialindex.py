@@ -0,0 +1,46 @@
+import os.path
+import pickle
+import pytest
+
+shapely = pytest.importorskip('shapely')
+if not hasattr(shapely, 'STRtree') or not hasattr(shapely, 'from_wkb'):
+    pytest.skip('ShapeIndex needs Shapely 2', allow_module_level=True)
+
+from pyosm.model import Node, Tag
+from pyosm.shapeify import get_shapes
+from pyosm.spatialindex import ShapeIndex, _MAGIC
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+def _index():
+    with open(os.path.join(FIXTURES, 'small.osm'), 'rb') as f:
+        return ShapeIndex(list(get_shapes(f)))
+
+def test_save_and_load(tmp_path):
+    index = _index()
+    path = str(tmp_path / 'index')
+    index.save(path)
+    loaded = ShapeIndex.load(path)
+
+    assert len(loaded) == len(index)
+    for (a, shape_a), (b, shape_b) in zip(index, loaded):
+        assert (type(a), a.id, a.tags) == (type(b), b.id, b.tags)
+        assert shape_a.equals(shape_b)
+    assert [p.id for p, s in loaded.query_bbox(-1, -34, 152, 52)] == [p.id for p, s in index.query_bbox(-1, -34, 152, 52)]
+
+    node = [p for p in loaded.primitives if p.id == 2][0]
+    assert node == Node(2, None, None, None, None, None, None, -33.8688197, 151.2092955,
+        [Tag(u'amenity', u'cafe'), Tag(u'name', u'Caf\xe9 <&> "Zo\xeb"')])
+
+def test_save_and_load_empty(tmp_path):
+    path = str(tmp_path / 'index')
+    ShapeIndex([]).save(path)
+    assert len(ShapeIndex.load(path)) == 0
+
+def test_load_refuses_pickles(tmp_path):
+    path = str(tmp_path / 'index')
+    with open(path, 'wb') as f:
+        f.write(_MAGIC)
+        pickle.dump(([], []), f)
+    with pytest.raises(Exception):
+        ShapeIndex.load(path)